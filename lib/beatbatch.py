@@ -0,0 +1,140 @@
+#!/bin/env python
+'''
+Functions for running getmatches or findmatches over many interval sets,
+in parallel worker processes
+'''
+
+import contextlib
+import multiprocessing
+
+import beatsequence as BS
+
+# beat analysis of sequences matched in this process, set in workers of a
+# pool given a beat table
+beatfunc = BS.beat_metrics
+
+def use_beat_table(filename):
+    """analyses sequences matched in this process with the beat table in
+    filename, or with beat_metrics if filename is None"""
+    global beatfunc
+    if filename is None:
+        beatfunc = BS.beat_metrics
+    else:
+        beatfunc = BS.BeatTable(filename)
+
+def match_lines(i, method='getmatches'):
+    """returns output filename and lines of results for interval set i,
+    using method 'getmatches' or 'findmatches', without writing results.
+    Lines are None if getmatches would write no file"""
+    if method == 'getmatches':
+        lines = BS.getmatches_lines(i, beatfunc=beatfunc)
+    elif method == 'findmatches':
+        lines = BS.collection_lines(BS.findmatches_collection(
+            i, beatfunc=beatfunc))
+    else:
+        raise ValueError, 'Unknown match method %s' % method
+    return BS.output_filename(i), lines
+
+def joined_lines(metrics, complexes, bois):
+    """iterates over the lines of joinfiles.py output, from iterables of
+    the metric sequences, complex matches and beats of interest of all
+    matches, in the same order.  Each iterable is only started once the
+    one before it is finished"""
+    yield "Metric Simples\n\n"
+    for metric in metrics:
+        yield "%s\n" % metric
+    yield "\nComplexsequences\n\n"
+    for match in complexes:
+        yield "%s\n" % match
+    yield "\nBeats of Interest\n"
+    for boi in bois:
+        yield "%s\n" % boi
+
+def _match_lines_star(args):
+    return match_lines(*args)
+
+def match_records(i, method='getmatches', bois=[9,5], threshold=0.8,
+                  optimal=False):
+    """returns list of results for interval set i, using method
+    'getmatches' (with optimal assignment if optimal) or 'findmatches'
+    with the given bois and threshold, one
+    (metric, metric beatscore, complex, complex beatscore, boi)
+    tuple for each metric sequence, with sequences as strings.  Complex,
+    complex beatscore and boi are None where no match was found"""
+    records = []
+    if method == 'getmatches':
+        results = BS.getmatches_results(i, bois=bois, threshold=threshold,
+                                        optimal=optimal,
+                                        beatfunc=beatfunc) or []
+    elif method == 'findmatches':
+        results = [(m.target_sequence, m.preferred_match,
+                    m.boilist[m.preferred_match_no])
+                   for m in BS.findmatches_collection(
+                       i, bois, threshold, beatfunc).collection]
+    else:
+        raise ValueError, 'Unknown match method %s' % method
+    for metric, match, boi in results:
+        if match is None:
+            records.append((str(metric), metric.beatscore, None, None, None))
+        else:
+            records.append((str(metric), metric.beatscore,
+                            str(match), match.beatscore, boi))
+    return records
+
+def _match_records_star(args):
+    return args[0], match_records(*args)
+
+def _init_worker(max_bytes, beat_table):
+    if max_bytes is not None:
+        BS.analysis_cache.set_max_bytes(max_bytes)
+    use_beat_table(beat_table)
+
+def make_pool(workers=None, max_bytes=None, beat_table=None):
+    """returns a pool of workers (default one per cpu), with the analysis
+    cache of each worker capped at max_bytes if given.  If beat_table is
+    given, each worker opens the beat table in that file, and matches
+    with it"""
+    if max_bytes is None and beat_table is None:
+        return multiprocessing.Pool(workers)
+    return multiprocessing.Pool(workers, _init_worker,
+                                (max_bytes, beat_table))
+
+@contextlib.contextmanager
+def running_pool(workers=None, max_bytes=None, beat_table=None):
+    """gives a pool from make_pool for a with block.  The pool is closed
+    when the block finishes, or terminated if it raises, and joined in
+    either case"""
+    pool = make_pool(workers, max_bytes, beat_table)
+    try:
+        yield pool
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def by_cost(interval_sets):
+    """returns interval sets in order of decreasing cost, estimated as
+    the number of distinct permutations of each set"""
+    return sorted(interval_sets, key=BS.permutation_count, reverse=True)
+
+def run_batch(interval_sets, method='getmatches', workers=None,
+              debug=False, max_bytes=None, beat_table=None):
+    """runs method ('getmatches' or 'findmatches') on each interval set
+    in a pool of workers (default one per cpu), writing the results as the
+    serial method would.  Most costly interval sets are started first.
+    If max_bytes is given, it caps the analysis cache of each worker, and
+    if beat_table is given, workers match with the beat table in that file.
+
+    Returns list of filenames written"""
+    interval_sets = by_cost(interval_sets)
+    written = []
+    with running_pool(workers, max_bytes, beat_table) as pool:
+        for filename, lines in pool.imap_unordered(
+                _match_lines_star, [(i, method) for i in interval_sets]):
+            if lines is not None:
+                BS.write_lines(filename, lines)
+                written.append(filename)
+            if debug:print filename,"completed"
+    return written
@@ -0,0 +1,112 @@
+#!/bin/env python
+'''
+Pipeline from candidate interval sets, through matching and wrong versions,
+to a stimulus file, with stages connected by bounded queues so stimuli are
+written as soon as they are ready
+'''
+
+import sys
+import random
+import threading
+from Queue import Queue
+
+import beatsequence as BS
+import beatbatch
+
+# Marks the end of a stage's output
+_DONE = object()
+
+class _StageError(object):
+    ''' Carries an exception from one stage to the next '''
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+def _stage(func, *args):
+    """starts thread running func(*args), which should put its output, then
+    _DONE, on its output queue.  Exceptions go to the queue given last in
+    args, as _StageError"""
+    out_queue = args[-1]
+    def run():
+        try:
+            func(*args)
+        except:
+            out_queue.put(_StageError(sys.exc_info()))
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def _get(queue):
+    """gets item from queue, raising exceptions from earlier stages"""
+    item = queue.get()
+    if isinstance(item, _StageError):
+        raise item.exc_info[0], item.exc_info[1], item.exc_info[2]
+    return item
+
+def _match_stage(interval_sets, pool, out_queue):
+    """puts match records with a complex match on out_queue, in order of
+    interval sets"""
+    for i, records in pool.imap(beatbatch._match_records_star,
+                                [(i, 'getmatches') for i in interval_sets]):
+        for record in records:
+            if record[2] is not None:
+                out_queue.put(record)
+    out_queue.put(_DONE)
+
+def _wrong_stage(seed, in_queue, out_queue):
+    """adds wrong versions of metric and complex sequences to records"""
+    rng = random.Random(seed)
+    used_metric = set()
+    used_complex = set()
+    while True:
+        record = _get(in_queue)
+        if record is _DONE:
+            break
+        metric, metric_score, match, match_score, boi = record
+        wrong_metric = BS.choose_wrong_version(BS.Sequence(metric), rng,
+                                               used_metric)
+        wrong_complex = BS.choose_wrong_version(BS.Sequence(match), rng,
+                                                used_complex)
+        out_queue.put((metric, match, boi, wrong_metric, wrong_complex))
+    out_queue.put(_DONE)
+
+def stimulus_line(metric, match, boi, wrong_metric, wrong_complex):
+    """returns line of stimulus file for a matched pair and their wrong
+    versions, as metric:complex;boi;wrong metric:wrong complex"""
+    return "%s:%s;%s;%s:%s\n" % (metric, match, boi,
+                                 wrong_metric or 'None',
+                                 wrong_complex or 'None')
+
+def run_pipeline(filename, interval_sets=None, workers=None, seed=None,
+                 queue_size=64, debug=False, max_bytes=None,
+                 beat_table=None):
+    """matches interval sets (default all sets of 5-9 intervals up to 4,
+    adding up to 12) with getmatches in a pool of workers, finds unique
+    wrong versions for each match, and writes each stimulus line to
+    filename as soon as it is ready.
+
+    Stimuli come in order of interval sets, and wrong versions are
+    repeatable for a given seed.  max_bytes and beat_table are as for
+    beatbatch.run_batch.  Returns number of lines written"""
+    if interval_sets is None:
+        interval_sets = BS.partitions(12, 4, 5, 9)
+    interval_sets = list(interval_sets)
+    matched = Queue(queue_size)
+    stimuli = Queue(queue_size)
+    lines = 0
+    with beatbatch.running_pool(workers, max_bytes, beat_table) as pool:
+        f = open(filename, "wt")
+        try:
+            _stage(_match_stage, interval_sets, pool, matched)
+            _stage(_wrong_stage, seed, matched, stimuli)
+            while True:
+                stimulus = _get(stimuli)
+                if stimulus is _DONE:
+                    break
+                f.write(stimulus_line(*stimulus))
+                f.flush()
+                lines += 1
+                if debug:print lines,"stimuli written"
+        finally:
+            f.close()
+    return lines
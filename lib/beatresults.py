@@ -0,0 +1,234 @@
+#!/bin/env python
+'''
+Compact binary files of match results, as written by match_records.
+
+A result file is a 16 byte header, followed by blocks of records, each
+block holding its records by column, so files are appended to a block at
+a time.  Each block is a 16 byte header giving the numbers of records and
+of metric and complex intervals, followed by the columns:
+
+  metric beatscores       float64, one per record
+  complex beatscores      float64, one per record, NaN if no match
+  metric offsets          uint32, one per record plus one, into metric
+                          intervals
+  complex offsets         uint32, as metric offsets
+  bois                    int16, one per record, 0 if no match
+  metric intervals        uint8
+  complex intervals       uint8
+
+padded to a multiple of 8 bytes.  Files are read through a memory map,
+so columns are numpy arrays viewing the file, and records are read
+without loading the whole file
+'''
+
+import os
+import struct
+
+import numpy as np
+
+import beatbatch
+
+RESULT_FILE_MAGIC = 'BRES'
+RESULT_FILE_VERSION = 1
+RESULT_FILE_HEADER = '<4sII4x'
+RESULT_BLOCK_HEADER = '<III4x'
+
+def _intervals(seq):
+    """returns list of intervals from a sequence string like 1122231,
+    or a sequence of intervals"""
+    if isinstance(seq, basestring):
+        return [int(e) for e in seq]
+    return list(seq)
+
+def _pad(nbytes):
+    return -nbytes % 8
+
+def block_bytes(records):
+    """returns a block of records, as (metric, metric beatscore, complex,
+    complex beatscore, boi) tuples from match_records, as a string"""
+    n = len(records)
+    metric_scores = np.zeros(n)
+    complex_scores = np.empty(n)
+    complex_scores[:] = np.nan
+    metric_offsets = np.zeros(n+1, dtype='<u4')
+    complex_offsets = np.zeros(n+1, dtype='<u4')
+    bois = np.zeros(n, dtype='<i2')
+    metric_values = []
+    complex_values = []
+    for k, (metric, metric_score, match, match_score, boi) in \
+            enumerate(records):
+        metric_values += _intervals(metric)
+        metric_offsets[k+1] = len(metric_values)
+        metric_scores[k] = metric_score
+        if match is not None:
+            complex_values += _intervals(match)
+            complex_scores[k] = match_score
+            bois[k] = boi
+        complex_offsets[k+1] = len(complex_values)
+    columns = [metric_scores.astype('<f8'), complex_scores.astype('<f8'),
+               metric_offsets, complex_offsets, bois,
+               np.array(metric_values, dtype='u1'),
+               np.array(complex_values, dtype='u1')]
+    data = ''.join(c.tostring() for c in columns)
+    return (struct.pack(RESULT_BLOCK_HEADER, n, len(metric_values),
+                        len(complex_values)) +
+            data + '\0' * _pad(len(data)))
+
+def append_records(filename, records):
+    """appends a block of records to the result file filename, creating it
+    if necessary"""
+    f = open(filename, 'ab')
+    try:
+        if f.tell() == 0:
+            f.write(struct.pack(RESULT_FILE_HEADER, RESULT_FILE_MAGIC,
+                                RESULT_FILE_VERSION, 0))
+        if records:
+            f.write(block_bytes(records))
+    finally:
+        f.close()
+
+class ResultBlock(object):
+    ''' Columns of one block of a result file, viewing the file '''
+    def __init__(self, data, offset):
+        header_size = struct.calcsize(RESULT_BLOCK_HEADER)
+        n, nmetric, ncomplex = struct.unpack(
+            RESULT_BLOCK_HEADER, data[offset:offset+header_size].tostring())
+        self.n = n
+        pos = offset + header_size
+        def column(dtype, count):
+            dtype = np.dtype(dtype)
+            a = data[pos:pos+dtype.itemsize*count].view(dtype)
+            return a, pos + dtype.itemsize*count
+        self.metric_scores, pos = column('<f8', n)
+        self.complex_scores, pos = column('<f8', n)
+        self.metric_offsets, pos = column('<u4', n+1)
+        self.complex_offsets, pos = column('<u4', n+1)
+        self.bois, pos = column('<i2', n)
+        self.metric_values, pos = column('u1', nmetric)
+        self.complex_values, pos = column('u1', ncomplex)
+        self.end = pos + _pad(pos - offset - header_size)
+
+    def metric(self, k):
+        """returns intervals of metric sequence of record k"""
+        return self.metric_values[self.metric_offsets[k]:
+                                  self.metric_offsets[k+1]]
+
+    def complex(self, k):
+        """returns intervals of complex match of record k, or None"""
+        if not self.bois[k]:
+            return None
+        return self.complex_values[self.complex_offsets[k]:
+                                   self.complex_offsets[k+1]]
+
+class ResultFile(object):
+    ''' Memory mapped result file
+
+    Iterating gives records as (metric, metric beatscore, complex, complex
+    beatscore, boi), with sequences as arrays of intervals viewing the
+    file, and complex, complex beatscore and boi None where there is no
+    match
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        header_size = struct.calcsize(RESULT_FILE_HEADER)
+        f = open(filename, 'rb')
+        magic, version, flags = struct.unpack(RESULT_FILE_HEADER,
+                                              f.read(header_size))
+        f.close()
+        if magic != RESULT_FILE_MAGIC or version != RESULT_FILE_VERSION:
+            raise ValueError, 'Not a result file: %s' % filename
+        if os.path.getsize(filename) > header_size:
+            self.data = np.memmap(filename, dtype='u1', mode='r')
+        else:
+            self.data = np.zeros(header_size, dtype='u1')
+        self.header_size = header_size
+
+    def blocks(self):
+        """iterates over the blocks of the file"""
+        offset = self.header_size
+        while offset < len(self.data):
+            block = ResultBlock(self.data, offset)
+            yield block
+            offset = block.end
+
+    def __len__(self):
+        return sum(block.n for block in self.blocks())
+
+    def __iter__(self):
+        for block in self.blocks():
+            for k in range(block.n):
+                boi = int(block.bois[k])
+                if boi:
+                    yield (block.metric(k), float(block.metric_scores[k]),
+                           block.complex(k),
+                           float(block.complex_scores[k]), boi)
+                else:
+                    yield (block.metric(k), float(block.metric_scores[k]),
+                           None, None, None)
+
+    def matches(self):
+        """iterates over (metric, complex, boi) for records with a match"""
+        for metric, metric_score, match, match_score, boi in self:
+            if match is not None:
+                yield metric, match, boi
+
+def sequence_string(intervals):
+    """returns string of an array of intervals, as str of a Sequence"""
+    return ''.join(str(i) for i in intervals)
+
+def joined_lines(filename):
+    """iterates over lines of all matches in result file filename, in the
+    format of joinfiles.py output, reading the file once for each part"""
+    results = ResultFile(filename)
+    def column(n):
+        for match in results.matches():
+            yield match[n]
+    return beatbatch.joined_lines(
+        (sequence_string(metric) for metric in column(0)),
+        (sequence_string(match) for match in column(1)),
+        column(2))
+
+def join_results(filenames, output, buffer_size=2**20):
+    """writes the blocks of each of the result files filenames, in turn,
+    to the result file output, copying a buffer at a time.  Returns number
+    of bytes of blocks copied"""
+    header_size = struct.calcsize(RESULT_FILE_HEADER)
+    out = open(output, 'wb')
+    out.write(struct.pack(RESULT_FILE_HEADER, RESULT_FILE_MAGIC,
+                          RESULT_FILE_VERSION, 0))
+    copied = 0
+    try:
+        for filename in filenames:
+            # check header
+            ResultFile(filename)
+            f = open(filename, 'rb')
+            f.seek(header_size)
+            while True:
+                data = f.read(buffer_size)
+                if not data: break
+                out.write(data)
+                copied += len(data)
+            f.close()
+    finally:
+        out.close()
+    return copied
+
+def run_result_batch(filename, interval_sets, method='getmatches',
+                     workers=None, debug=False, max_bytes=None,
+                     beat_table=None):
+    """runs method ('getmatches' or 'findmatches') on each interval set
+    in a pool of workers, appending a block of results for each set to
+    the result file filename.  Most costly interval sets are started
+    first, and blocks are written in that order, whatever order the sets
+    finish in, so the file is the same from run to run.  max_bytes and
+    beat_table are as for beatbatch.run_batch.  Returns number of
+    interval sets run"""
+    interval_sets = beatbatch.by_cost(interval_sets)
+    append_records(filename, [])
+    with beatbatch.running_pool(workers, max_bytes, beat_table) as pool:
+        for i, records in pool.imap(
+                beatbatch._match_records_star,
+                [(i, method) for i in interval_sets]):
+            append_records(filename, records)
+            if debug:print i,"completed"
+    return len(interval_sets)
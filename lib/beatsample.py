@@ -0,0 +1,218 @@
+#!/bin/env python
+'''
+Sampling of random orderings of interval sets too long to search
+exhaustively, giving metric sequences and their complex matches in the
+same structures as beatsequence
+'''
+
+import random
+import time
+
+import numpy as np
+
+import beatsequence as BS
+
+class Reservoir(object):
+    ''' Uniform random sample of at most size of the items added to it '''
+    def __init__(self, size, rng):
+        self.size = size
+        self.rng = rng
+        self.items = []
+        self.added = 0
+
+    def add(self, item):
+        self.added += 1
+        if len(self.items) < self.size:
+            self.items.append(item)
+        else:
+            n = self.rng.randrange(self.added)
+            if n < self.size:
+                self.items[n] = item
+
+class OrderingSampler(object):
+    ''' Random distinct orderings of an interval set, scored in batches,
+    keeping reservoirs of metric sequences (as for all_metric) and of
+    complex sequences for each boi and window of onsets around it (as for
+    matched_complex)
+
+    Orderings are drawn uniformly, with repeats discarded, so the
+    proportions of metric and complex sequences found estimate those of
+    the whole permutation space
+    '''
+    def __init__(self, intervals, bois=[9,5], threshold=0.8,
+                 basegroup=4, upbeat=0, beatfunc=BS.beat_metrics,
+                 reservoir_size=1000, seed=None):
+        self.intervals = sorted(intervals)
+        self.bois = list(bois)
+        self.threshold = threshold
+        self.basegroup = basegroup
+        self.upbeat = upbeat
+        self.beatfunc = beatfunc
+        self.reservoir_size = reservoir_size
+        self.length = sum(intervals)
+        for boi in self.bois:
+            if boi<=4 or boi>=self.length-1:raise ValueError , \
+                "beat of interest invalid for sequence"
+        self.total = BS.permutation_count(intervals)
+        self._np_rng = np.random.RandomState(seed)
+        self._rng = random.Random(seed)
+        self.samples = 0
+        self._seen = set()
+        self.metric = Reservoir(reservoir_size, self._rng)
+        # complex sequences by (boi, window bitmask)
+        self.complex = {}
+        self.complex_found = 0
+        self._made = {}
+
+    def _score(self, onsets):
+        """returns arrays of beatscore, basegroup and upbeat for onsets"""
+        if isinstance(self.beatfunc, (BS.BeatTable, BS.BeatAnalyser)):
+            return self.beatfunc.batch_beat_metrics(onsets)
+        if self.beatfunc is BS.beat_metrics:
+            return BS.batch_beat_metrics(onsets)
+        rows = [self.beatfunc(row.tolist()) for row in onsets]
+        return [np.array(v) for v in zip(*rows)]
+
+    def run(self, seconds=None, samples=None, batch_size=1000):
+        """draws orderings in batches of batch_size until seconds have
+        passed, samples orderings have been drawn, or every distinct
+        ordering has been seen.  With neither limit, draws one batch.
+
+        Returns coverage()"""
+        start = time.time()
+        base = np.array(self.intervals)
+        drawn = 0
+        while len(self._seen) < self.total:
+            if seconds is not None and time.time()-start >= seconds:
+                break
+            if samples is not None and drawn >= samples:
+                break
+            n = batch_size
+            if samples is not None: n = min(n, samples-drawn)
+            order = self._np_rng.rand(n, len(base)).argsort(axis=1)
+            self._add_batch(base[order])
+            drawn += n
+            if seconds is None and samples is None:
+                break
+        return self.coverage()
+
+    def _add_batch(self, intervals):
+        """scores orderings, one per row of intervals, adding those not
+        seen before to the reservoirs"""
+        self.samples += len(intervals)
+        new = []
+        for n, row in enumerate(intervals):
+            key = row.tostring()
+            if key not in self._seen:
+                self._seen.add(key)
+                new.append(n)
+        if not new:
+            return
+        intervals = intervals[new]
+        onsets = BS.intervals_to_onset_array(intervals)
+        beatscores, basegroups, upbeats = self._score(onsets)
+        metric = (beatscores==1.0) & (basegroups==self.basegroup) & \
+            (upbeats==self.upbeat)
+        exclude = BS.exclude_function(self.beatfunc)
+        for n in np.flatnonzero(metric):
+            if not exclude(onsets[n].tolist()):
+                self.metric.add(tuple(intervals[n].tolist()))
+        complex = np.flatnonzero(beatscores <= self.threshold)
+        self.complex_found += len(complex)
+        for boi in self.bois:
+            windows = onsets[complex, boi-4:boi+2] != 0
+            codes = windows.dot(1 << np.arange(windows.shape[1]))
+            for n, code in zip(complex, codes):
+                key = (boi, int(code))
+                if key not in self.complex:
+                    self.complex[key] = Reservoir(self.reservoir_size,
+                                                  self._rng)
+                self.complex[key].add((beatscores[n],
+                                       tuple(intervals[n].tolist())))
+
+    def coverage(self):
+        """returns dictionary of the numbers of orderings drawn, distinct
+        orderings seen, and in all, the fraction seen, and the numbers of
+        metric and complex sequences found, with estimates of the numbers
+        in all orderings"""
+        seen = len(self._seen)
+        def estimate(found):
+            if not seen: return None
+            return found * 1.0 * self.total / seen
+        return {'samples': self.samples,
+                'distinct': seen,
+                'total': self.total,
+                'coverage': seen * 1.0 / self.total,
+                'metric': self.metric.added,
+                'metric_estimate': estimate(self.metric.added),
+                'complex': self.complex_found,
+                'complex_estimate': estimate(self.complex_found)}
+
+    def _sequence(self, intervals):
+        """returns Sequence for intervals, shared between calls"""
+        if intervals not in self._made:
+            self._made[intervals] = BS.Sequence(list(intervals),
+                                                self.beatfunc)
+        return self._made[intervals]
+
+    def all_metric(self):
+        """returns list of the metric sequences sampled, in lexicographic
+        order of intervals, as for Sequence.all_metric"""
+        return [self._sequence(i) for i in sorted(self.metric.items)]
+
+    def matched_complex(self, seq):
+        """returns a list of the complex sequences sampled which match seq
+        around each boi, and a list of their bois, in the order of
+        Sequence.matched_complex"""
+        L = []
+        onsets = seq.onsets
+        for boi in self.bois:
+            code = BS.onsets_to_bitmask(onsets[boi-4:boi+2])
+            reservoir = self.complex.get((boi, code))
+            if reservoir is None: continue
+            L += [(score, intervals, boi)
+                  for score, intervals in sorted(reservoir.items)]
+        # stable sort on beatscore, keeping bois in order
+        L.sort(key=lambda x: x[0])
+        last_boi = {}
+        for score, intervals, boi in L:
+            last_boi[intervals] = boi
+        return ([self._sequence(intervals) for score, intervals, boi in L],
+                [last_boi[intervals] for score, intervals, boi in L])
+
+    def matched_sequence(self, seq):
+        """returns MatchedSequence for seq, with the sampled matches"""
+        S, bois = self.matched_complex(seq)
+        return BS.MatchedSequence(seq, pairs=zip(S, bois))
+
+def findmatches_collection(sampler):
+    """returns a MatchedSequenceCollection as for
+    beatsequence.findmatches_collection, from the orderings sampled"""
+    msc = BS.MatchedSequenceCollection()
+    for s in sampler.all_metric():
+        ms = sampler.matched_sequence(s)
+        if ms.matches:
+            try:
+                msc.append_attempt(ms)
+            except ValueError:
+                continue
+    return msc
+
+def getmatches_results(sampler):
+    """returns list of (metric sequence, complex match, beat of interest)
+    as for beatsequence.getmatches_results, from the orderings sampled"""
+    metrics = sampler.all_metric()
+    if not metrics:
+        return None
+    used = set()
+    results = []
+    for s in metrics:
+        S, bois = sampler.matched_complex(s)
+        for m, boi in zip(S, bois):
+            if m not in used:
+                used.add(m)
+                results.append((s, m, boi))
+                break
+        else:
+            results.append((s, None, None))
+    return results
@@ -6,8 +6,16 @@ according to beat properties
 Author: Sam Burnand
 '''
 
+import heapq
+import itertools
+import json
 import random
-import copy
+import struct
+import sys
+import time
+from collections import OrderedDict
+
+import numpy as np
 
 def totalsort(x,y):
     '''function for sorting lists of integers by the totals'''
@@ -36,42 +44,327 @@ def valueperm(maxlist):
     S.sort(totalsort)
     return S
 
+def partitions(total, largest=None, min_length=1, max_length=None):
+    """returns an iterator giving each multiset of positive integers no
+    greater than largest (default total), adding up to total, with
+    between min_length and max_length (default total) members.
+
+    Multisets are sorted lists, given in order of length, then
+    lexicographically"""
+    if largest is None: largest = total
+    if max_length is None: max_length = total
+    for length in range(min_length, max_length+1):
+        for p in _partitions(total, length, 1, largest):
+            yield p
+
+def _partitions(total, length, smallest, largest):
+    """partitions of total into length parts from smallest to largest,
+    as non-decreasing lists"""
+    if length == 1:
+        if smallest <= total <= largest:
+            yield [total]
+        return
+    for first in range(smallest, largest+1):
+        rest = total - first
+        # the rest can't be smaller than first, so later firsts fail too
+        if rest < first*(length-1): break
+        if rest > largest*(length-1): continue
+        for p in _partitions(rest, length-1, first, largest):
+            yield [first] + p
+
+def compositions(total, largest=None, min_length=1, max_length=None):
+    """returns an iterator giving each sequence of positive integers no
+    greater than largest (default total), adding up to total, with
+    between min_length and max_length (default total) members.
+
+    Sequences are lists, given in order of length, then
+    lexicographically"""
+    if largest is None: largest = total
+    if max_length is None: max_length = total
+    for length in range(min_length, max_length+1):
+        for c in _compositions(total, length, largest):
+            yield c
+
+def _compositions(total, length, largest):
+    """compositions of total into length parts up to largest"""
+    if length == 1:
+        if 1 <= total <= largest:
+            yield [total]
+        return
+    for first in range(max(1, total-largest*(length-1)),
+                       min(largest, total-(length-1))+1):
+        for c in _compositions(total-first, length-1, largest):
+            yield [first] + c
+
+def estimate_nbytes(value):
+    """returns a rough estimate of the memory used by value, following
+    tuples and lists, and including the data of numpy arrays"""
+    if isinstance(value, np.ndarray):
+        # the size of an array owning its data already includes the data,
+        # but that of a view doesn't
+        if value.base is None:
+            return sys.getsizeof(value)
+        return sys.getsizeof(value) + value.nbytes
+    nbytes = sys.getsizeof(value)
+    if isinstance(value, (tuple, list)):
+        for v in value:
+            nbytes += estimate_nbytes(v)
+    elif isinstance(value, dict):
+        for k, v in value.iteritems():
+            nbytes += estimate_nbytes(k) + estimate_nbytes(v)
+    elif isinstance(value, Sequence):
+        nbytes += estimate_nbytes(value._intervals) + \
+            estimate_nbytes(value._metrics)
+    return nbytes
+
+class AnalysisCache(object):
+    ''' Process wide cache of sequence analysis results, discarding least
+    recently used results when the estimated memory used by the cached
+    results goes over max_bytes
+
+    Keys are tuples, with the first element naming the kind of analysis,
+    which is used to keep hit and miss counts for each kind
+    '''
+    def __init__(self, max_bytes=64*2**20):
+        self.max_bytes = max_bytes
+        self.clear()
+
+    def clear(self):
+        ''' Empties cache and resets statistics '''
+        self._entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = {}
+        self.misses = {}
+        self.evictions = 0
+
+    def get(self, key):
+        ''' returns cached value for key, or None if not cached '''
+        kind = key[0]
+        try:
+            value, nbytes = self._entries.pop(key)
+        except KeyError:
+            self.misses[kind] = self.misses.get(kind, 0) + 1
+            return None
+        # reinsert as most recently used
+        self._entries[key] = (value, nbytes)
+        self.hits[kind] = self.hits.get(kind, 0) + 1
+        return value
+
+    def put(self, key, value):
+        ''' caches value for key, evicting old values if necessary '''
+        nbytes = estimate_nbytes(key) + estimate_nbytes(value)
+        if nbytes > self.max_bytes:
+            return
+        if key in self._entries:
+            self.nbytes -= self._entries.pop(key)[1]
+        self._entries[key] = (value, nbytes)
+        self.nbytes += nbytes
+        self._evict()
+
+    def set_max_bytes(self, max_bytes):
+        ''' sets memory cap, evicting old values if necessary '''
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def _evict(self):
+        ''' discards least recently used values until under memory cap '''
+        while self._entries and self.nbytes > self.max_bytes:
+            old_value, old_nbytes = self._entries.popitem(last=False)[1]
+            self.nbytes -= old_nbytes
+            self.evictions += 1
+
+    def stats(self):
+        ''' returns dictionary of cache statistics '''
+        return {'entries': len(self._entries),
+                'nbytes': self.nbytes,
+                'max_bytes': self.max_bytes,
+                'hits': dict(self.hits),
+                'misses': dict(self.misses),
+                'evictions': self.evictions}
+
+    def __len__(self):
+        return len(self._entries)
+
+# The cache shared by all sequences
+analysis_cache = AnalysisCache()
+
+class Instrumentation(object):
+    ''' Counters and per-phase timers for sequence analysis, with an
+    optional stream of events written as JSON lines
+
+    Phases are timed when their results are not cached, and can include
+    other phases, as when matching first needs the permutations.  Counts
+    of analysis cache hits and misses are those since the instrumentation
+    was created or last cleared
+    '''
+    def __init__(self, stream=None):
+        self.stream = stream
+        self.clear()
+
+    def clear(self):
+        ''' Resets counters and timers '''
+        self.counts = {}
+        self.times = {}
+        self.calls = {}
+        self._cache_hits = dict(analysis_cache.hits)
+        self._cache_misses = dict(analysis_cache.misses)
+
+    def count(self, name, n=1):
+        ''' adds n to counter name '''
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def add_time(self, phase, seconds, intervals=None):
+        ''' adds seconds to the timer for phase, writing a phase event '''
+        self.times[phase] = self.times.get(phase, 0) + seconds
+        self.calls[phase] = self.calls.get(phase, 0) + 1
+        if self.stream is not None:
+            self.event('phase', phase=phase, seconds=seconds,
+                       intervals=intervals)
+
+    def event(self, kind, **fields):
+        ''' writes event to the stream, if any, as a line of JSON '''
+        if self.stream is None:
+            return
+        fields['event'] = kind
+        fields['time'] = time.time()
+        self.stream.write(json.dumps(fields) + "\n")
+
+    def stats(self):
+        ''' returns dictionary of counters and timers '''
+        def since(now, then):
+            return dict((k, v - then.get(k, 0)) for k, v in now.items()
+                        if v != then.get(k, 0))
+        return {'counts': dict(self.counts),
+                'times': dict(self.times),
+                'calls': dict(self.calls),
+                'cache_hits': since(analysis_cache.hits, self._cache_hits),
+                'cache_misses': since(analysis_cache.misses,
+                                      self._cache_misses)}
+
+# Instrumentation in use, or None.  Instrumented code checks this first,
+# so when it is None instrumentation costs only that check
+instrumentation = None
+
+def enable_instrumentation(stream=None):
+    """starts instrumentation of sequence analysis, with events written
+    to stream as JSON lines if given.  Returns the Instrumentation"""
+    global instrumentation
+    instrumentation = Instrumentation(stream)
+    return instrumentation
+
+def disable_instrumentation():
+    """stops instrumentation, returning the Instrumentation used, if any"""
+    global instrumentation
+    old = instrumentation
+    instrumentation = None
+    return old
+
+def permutation_count(intervals):
+    """returns the number of distinct permutations of intervals"""
+    count = 1
+    n = 0
+    for v in set(intervals):
+        for k in range(1, list(intervals).count(v)+1):
+            n += 1
+            count = count * n / k
+    return count
+
+def output_filename(i):
+    """returns name of output file for results for interval set i"""
+    return "outputsequences/"+Sequence(i).__str__()+".txt"
+
+def write_lines(filename, lines):
+    """writes lines of results to filename"""
+    f=open(filename, "wt")
+    f.writelines(lines)
+    f.close()
+
 def findmatches(i):
     """returns a MatchedSequenceCollection with as many metric re-arrangements
     of the interval set as possible, 
     along with their matched complex sequences
     
     finds all matches, but can be extremely slow"""
-    seq=Sequence(i)
+    msc = findmatches_collection(i)
+    #write results to a file
+    write_lines(output_filename(i), collection_lines(msc))
+    return msc
+
+def findmatches_collection(i,bois=[9,5],threshold=0.8,beatfunc=None):
+    """returns the MatchedSequenceCollection for findmatches, without
+    writing results, matching with the given bois and threshold, and
+    analysing sequences with beatfunc (default beat_metrics)"""
+    seq=Sequence(i,beatfunc or beat_metrics)
     msc = MatchedSequenceCollection()
     #find all the metric possibilities
     for s in seq.all_metric():
-        ms = MatchedSequence(s)
+        ms = MatchedSequence(s, lazy=True, bois=bois, threshold=threshold)
         # Add this match to match collection, if any matches found 
         if ms.matches:
             try:
                 msc.append_attempt(ms)
             except ValueError:
                 continue
-    #write results to a file
-    filename="outputsequences/"+seq.__str__()+".txt"
-    f=open(filename, "wt")
+    return msc
+
+def collection_lines(msc):
+    """returns lines of findmatches results for a MatchedSequenceCollection"""
+    lines=[]
     for i,m in enumerate(msc.collection):
-        f.write("%s : %s ; boi=%s\n" %
+        lines.append("%s : %s ; boi=%s\n" %
         (m.target_sequence, m.preferred_match, m.boilist[m.preferred_match_no]))
-    f.close()
-    return msc
+    return lines
 
-def getmatches(i,debug=False):
+def getmatches(i,debug=False,optimal=False):
     """works in a similar way to findmatches, but checks less carefully for
-    possible combinations. Much faster"""
-    seq=Sequence(i)
+    possible combinations. Much faster
+
+    If optimal, matches for all metric sequences are chosen together, as
+    by getmatches_results"""
+    lines=getmatches_lines(i,debug,optimal)
+    if lines is not None:
+        write_lines(output_filename(i), lines)
+
+def getmatches_lines(i,debug=False,optimal=False,beatfunc=None):
+    """returns lines of getmatches results, or None if there are no metric
+    re-arrangements, without writing results"""
+    results=getmatches_results(i,debug,optimal=optimal,beatfunc=beatfunc)
+    if results is None:
+        return None
+    return results_lines(results)
+
+def results_lines(results):
+    """returns lines of getmatches results, from a list of (metric sequence,
+    complex match, beat of interest) as given by getmatches_results"""
+    lines=[]
+    for p,m,b in results:
+        if m is not None:
+            lines.append("%s:%s;%s\n" % (p.__str__(), m.__str__(), b))
+    return lines
+
+def getmatches_results(i,debug=False,bois=[9,5],threshold=0.8,
+                       optimal=False,beatfunc=None):
+    """returns list of (metric sequence, complex match, beat of interest)
+    for getmatches, with match and beat of interest None where no match
+    was found, or None if there are no metric re-arrangements.  Matches
+    are found with the given bois and threshold, analysing sequences with
+    beatfunc (default beat_metrics).
+
+    Each metric sequence takes its first match not already taken.  If
+    optimal, matches are instead chosen by optimal_assignment, matching
+    as many metric sequences as possible, with the lowest total beatscore
+    of the matches.  The number of metric sequences matched that the
+    first way would have left without a match is printed if debug, and
+    counted as 'rescued' by instrumentation"""
+    inst=instrumentation
+    if inst is not None:start=time.time()
+    seq=Sequence(i,beatfunc or beat_metrics)
     if debug:print"Checking:",seq
     metrics=[]
     for n in seq.all_metric():
         metrics.append(n)
     if debug:print len(metrics),"metric sequences found"
-    allcomplex=[]
+    allcomplex=set()
     #create a list for results, the indices of which will match those of the metric sequence
     results=[]
     #A similar list, for beats of interest
@@ -79,47 +372,311 @@ def getmatches(i,debug=False):
     for i in range(len(metrics)):
         results.append(0)
         boi.append(0)
+    candidates=[]
     for i,s in enumerate(metrics):
         if debug:print "finding complex matches for",s
-        matched,bois=s.matched_complex()
+        matched,boilist=s.matched_complex(bois,threshold)
+        candidates.append((matched,boilist))
         for b,m in enumerate(matched):
-            if m.intervals not in allcomplex:
-                allcomplex.append(m.intervals)
+            if m not in allcomplex:
+                allcomplex.add(m)
                 results[i]=m
-                boi[i]=bois[b]
+                boi[i]=boilist[b]
                 break         
+    if optimal:
+        greedy=len(allcomplex)
+        options=[[(int(round(m.beatscore*100)),m) for m in matched]
+                 for matched,boilist in candidates]
+        for i,b in enumerate(optimal_assignment(options)):
+            if b is None:
+                results[i]=0
+                boi[i]=0
+            else:
+                results[i]=candidates[i][0][b]
+                boi[i]=candidates[i][1][b]
+        allcomplex=set(m for m in results if m)
+        if debug:print len(allcomplex)-greedy,"rescued"
+        if inst is not None:inst.count('rescued',len(allcomplex)-greedy)
     if debug:print"Results:"
     if debug:
         for i,p in enumerate(metrics):
             if results[i]!=0:print p.intervals,":",\
                     results[i].intervals," beat of interest:",boi[i]
             else: print p.intervals,": None found"
-    if metrics:
-        filename="outputsequences/"+seq.__str__()+".txt"
-        f=open(filename, "wt")
-        for i,p in enumerate(metrics):
-            if results[i]:
-                f.write("%s:%s;%s\n" %
-                        (p.__str__(), results[i].__str__(), boi[i]))
-        f.close()
+    if inst is not None:
+        inst.count('multisets')
+        inst.event('getmatches', intervals=sorted(seq.intervals),
+                   metric=len(metrics), matched=len(allcomplex),
+                   seconds=time.time()-start)
+    if not metrics:
+        return None
+    return [(p, results[i] or None, boi[i] or None)
+            for i,p in enumerate(metrics)]
     
-def permIter(seq):
-    """Given some sequence 'seq', returns an iterator that gives
-    all permutations of that sequence.
-    http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/105962
+def optimal_assignment(options):
+    """Given a list of options for each target, each a list of (cost, key)
+    with integer costs, returns a list giving the index of the option
+    chosen for each target, or None, so that no key is chosen twice, as
+    many targets as possible have a choice, and the total cost of the
+    choices is as low as possible.
+
+    Choices are made by an Assignment, one augmenting path at a time"""
+    assignment=Assignment()
+    for target_options in options:
+        assignment.add_target(target_options)
+    while assignment.augment() is not None:
+        pass
+    return [ch and ch[2] for ch in assignment.choice]
+
+class Assignment(object):
+    ''' Assignment of keys to targets, each target choosing at most one
+    of its options, given as (cost, key) pairs, and no key chosen twice
+
+    Targets and options can be added at any time.  Each augment gives one
+    more target a choice by the cheapest augmenting path, so the choices
+    have the lowest total cost for their number.  Paths are found with
+    Dijkstra's algorithm, using potentials kept between paths to keep
+    edge costs positive.  Options added which would make an edge cost
+    negative are usually absorbed by the potentials; when they can't be,
+    the potentials are found again with Bellman-Ford before the next path
+    '''
+    def __init__(self):
+        self.edges = []     # for each target, (candidate, cost, option)
+        self.noptions = []
+        self._keys = []
+        self.choice = []    # for each target, (candidate, cost, option)
+        self.numbers = {}   # candidate number of each key
+        self.owner = []     # target choosing each candidate
+        self.u = []         # potentials of targets
+        self.v = []         # potentials of candidates
+        self._feasible = True
+
+    def add_target(self, options=()):
+        """adds a target with options, returning its number"""
+        self.edges.append([])
+        self.noptions.append(0)
+        self._keys.append(set())
+        self.choice.append(None)
+        self.u.append(0)
+        t = len(self.edges)-1
+        self.add_options(t, options)
+        return t
+
+    def add_options(self, t, options):
+        """adds options to target t, numbered on from its earlier options.
+        Options with a key the target already has are skipped"""
+        u, v = self.u, self.v
+        for cost, key in options:
+            n = self.noptions[t]
+            self.noptions[t] += 1
+            if key in self._keys[t]: continue
+            self._keys[t].add(key)
+            c = self.numbers.get(key)
+            if c is None:
+                c = self.numbers[key] = len(self.owner)
+                self.owner.append(None)
+                v.append(cost + u[t])
+            elif cost + u[t] < v[c]:
+                # keep the edge cost positive, moving the potential of
+                # whichever end has no chosen edge to keep right
+                if self.owner[c] is None:
+                    v[c] = cost + u[t]
+                elif self.choice[t] is None:
+                    u[t] = v[c] - cost
+                else:
+                    self._feasible = False
+            self.edges[t].append((c, cost, n))
+
+    def assign(self, t, n):
+        """makes target t choose its option n, if its key is free.  Returns
+        true if it was chosen"""
+        for c, cost, option in self.edges[t]:
+            if option == n:
+                break
+        else:
+            return False
+        if self.owner[c] is not None or self.choice[t] is not None:
+            return False
+        self.choice[t] = (c, cost, n)
+        self.owner[c] = t
+        self._feasible = False
+        return True
+
+    def remove_last(self):
+        """removes the last target added, which must have no choice"""
+        if self.choice[-1] is not None:
+            raise ValueError, "Last target has a choice"
+        for x in (self.edges, self.noptions, self._keys, self.choice,
+                  self.u):
+            x.pop()
+
+    def augment(self, sources=None, max_cost=None):
+        """finds the cheapest augmenting path from one of the targets
+        sources (default all without a choice) to an unchosen key, which
+        gives that target a choice, changing the choices of targets along
+        the way.  Returns (cost, path), with the change in total cost, and
+        the path as a list of (target, option) choices, or None if there
+        is no path.
+
+        The path is taken unless its cost is max_cost or more"""
+        if not self._feasible:
+            self._find_potentials()
+        edges, choice, owner, u, v = (self.edges, self.choice, self.owner,
+                                      self.u, self.v)
+        if sources is None:
+            sources = [t for t in range(len(edges)) if choice[t] is None]
+        free = [v[c] for c in range(len(owner)) if owner[c] is None]
+        if not sources or not free:
+            return None
+        # potentials of a source before the targets and a sink after the
+        # unchosen keys, keeping the edges to and from them positive
+        top = max(u[t] for t in sources)
+        bottom = min(free)
+        dist = [None]*len(edges)
+        distc = [None]*len(owner)
+        previous = [None]*len(owner)
+        heap = []
+        for t in sources:
+            dist[t] = top - u[t]
+            heap.append((dist[t], t))
+        heapq.heapify(heap)
+        best = None
+        limit = None
+        while heap:
+            d, t = heapq.heappop(heap)
+            if d > dist[t]: continue
+            if limit is not None and d >= limit: break
+            for c, cost, n in edges[t]:
+                if choice[t] is not None and choice[t][0] == c: continue
+                dc = d + cost + u[t] - v[c]
+                if distc[c] is not None and dc >= distc[c]: continue
+                distc[c] = dc
+                previous[c] = (t, cost, n)
+                o = owner[c]
+                if o is None:
+                    if limit is None or dc + v[c] - bottom < limit:
+                        best = c
+                        limit = dc + v[c] - bottom
+                    continue
+                # move along the chosen edge, back to its target
+                do = dc - choice[o][1] + v[c] - u[o]
+                if dist[o] is None or do < dist[o]:
+                    dist[o] = do
+                    heapq.heappush(heap, (do, o))
+        if best is None:
+            return None
+        # walk back along the path from the unchosen key
+        path = []
+        total = 0
+        c = best
+        while c is not None:
+            t, cost, n = previous[c]
+            old = choice[t]
+            path.append((t, c, cost, n))
+            total += cost - (old and old[1] or 0)
+            c = old and old[0]
+        if max_cost is not None and total >= max_cost:
+            return total, [(t, n) for t, c, cost, n in path]
+        for t in range(len(edges)):
+            if dist[t] is not None: u[t] += min(dist[t], limit)
+            else: u[t] += limit
+        for c in range(len(owner)):
+            if distc[c] is not None: v[c] += min(distc[c], limit)
+            else: v[c] += limit
+        for t, c, cost, n in path:
+            choice[t] = (c, cost, n)
+            owner[c] = t
+        return total, [(t, n) for t, c, cost, n in path]
+
+    def _find_potentials(self):
+        """finds potentials keeping all edge costs positive, with
+        Bellman-Ford, first taking any changes of choices which lower the
+        total cost without changing which targets have a choice"""
+        nt = len(self.edges)
+        # candidate c is node nt+c, and a sink after the unchosen keys is
+        # the last node, so changing to an unchosen key is also a cycle
+        sink = nt + len(self.owner)
+        nodes = sink + 1
+        while True:
+            # a chosen edge is taken backwards
+            arcs = []
+            for t, edges in enumerate(self.edges):
+                for c, cost, n in edges:
+                    if self.choice[t] is not None and \
+                            self.choice[t][0] == c:
+                        arcs.append((nt+c, t, -cost, None))
+                    else:
+                        arcs.append((t, nt+c, cost, (t, c, cost, n)))
+            for c, owner in enumerate(self.owner):
+                if owner is None:
+                    arcs.append((nt+c, sink, 0, None))
+                else:
+                    # the key is given up
+                    arcs.append((sink, nt+c, 0, (None, c, 0, None)))
+            dist = [0]*nodes
+            previous = [None]*nodes
+            for round in range(nodes+1):
+                changed = None
+                for a, b, cost, edge in arcs:
+                    if dist[a] + cost < dist[b]:
+                        dist[b] = dist[a] + cost
+                        previous[b] = (a, edge)
+                        changed = b
+                if changed is None: break
+            if changed is None:
+                self.u = dist[:nt]
+                self.v = dist[nt:sink]
+                self._feasible = True
+                return
+            # still changing, so on or after a cycle of negative cost
+            for i in range(nodes):
+                changed = previous[changed][0]
+            node = changed
+            while True:
+                node, edge = previous[node]
+                if edge is not None:
+                    t, c, cost, n = edge
+                    if t is None:
+                        self.owner[c] = None
+                    else:
+                        self.choice[t] = (c, cost, n)
+                        self.owner[c] = t
+                if node == changed: break
+
+def multiset_permutations(seq):
+    """Given some sequence 'seq', returns an iterator that gives each
+    distinct permutation of that sequence exactly once, as lists, in
+    lexicographic order.
+
+    Repeated values are never permuted amongst themselves, so no
+    duplicates are generated and no membership checks are needed.
     """
-    ## Base case
-    if len(seq) == 1:
-        yield(seq)
-        raise StopIteration
-
-    ## Inductive case
-    for i in range(len(seq)):
-        element_slice = seq[i:i+1]
-        rest_iter = permIter(seq[:i] + seq[i+1:])
-        for rest in rest_iter:
-            yield(element_slice + rest)
-    raise StopIteration
+    for L, changed in _lex_steps(seq):
+        yield L[:]
+
+def _lex_steps(seq):
+    """returns an iterator giving (L, changed) for each distinct permutation
+    of seq in lexicographic order, where L is a list, reused for each
+    permutation, and changed is the first index changed since the
+    previous permutation"""
+    L = sorted(seq)
+    n = len(L)
+    changed = 0
+    while True:
+        yield L, changed
+        # find rightmost position that can be increased
+        i = n - 2
+        while i >= 0 and L[i] >= L[i+1]:
+            i -= 1
+        if i < 0:
+            return
+        # swap with the rightmost larger value, and reverse the tail
+        j = n - 1
+        while L[j] <= L[i]:
+            j -= 1
+        L[i], L[j] = L[j], L[i]
+        L[i+1:] = L[:i:-1]
+        changed = i
 
 def calculate_beatscore(onsets, basegroup, upbeat):
     """gives a score based on how frequently onsets
@@ -137,19 +694,102 @@ def calculate_beatscore(onsets, basegroup, upbeat):
             beats+=1
     return 1.0*beats/beatno
 
-def beat_metrics(onsets, beatfunc=calculate_beatscore, debug=False):
+def beat_metrics(onsets, beatfunc=calculate_beatscore, debug=False,
+                 table=None, basegroups=(4,3)):
     """ Returns beatscore, basegroup and upbeat values, 
-    depending on how the sequence best groups (based on beatscores)"""
-    # grouping in g with upbeat of u
-    s=0
-    for g in range(4,2,-1):
+    depending on how the sequence best groups (based on beatscores)
+
+    Groupings in each of basegroups are tried in turn, with each
+    upbeat, and the first with the best score is used.  If a BeatTable
+    is given as table, sequences of its length are looked up in the
+    table rather than being scored"""
+    if table is not None and len(onsets)==table.length:
+        return table(onsets)
+    if beatfunc is calculate_beatscore:
+        s,basegroup,upbeat=best_grouping(onsets_to_bitmask(onsets),
+                                         len(onsets), basegroups)
+    else:
+        # grouping in g with upbeat of u
+        s=0
+        for g in basegroups:
+            for u in range(g):
+                if onsets[u]:
+                    p=beatfunc(onsets, g, u)
+                    if p>s:
+                        s=p
+                        basegroup=g
+                        upbeat=u
+    if s==0:raise ValueError, "No grouping found for sequence"
+    beatscore=penalised_beatscore(onsets, s, basegroup, upbeat)
+    if debug:
+        print "Score of",beatscore,", grouping in", basegroup,\
+              ", upbeat of",upbeat
+    return beatscore, basegroup, upbeat
+
+# groupings for each length and basegroups, as made by _groupings
+_grouping_cache = {}
+
+def _groupings(length, basegroups):
+    """returns the groupings of a sequence of length pulses in each of
+    basegroups, as a list of (basegroup, least beatno, [(upbeat, beatno,
+    beat bitmask), ...]), along with a bitmask of the upbeats of groupings
+    too short to analyse.  Beatno is the number of beats after the first,
+    as in calculate_beatscore"""
+    key = (length, basegroups)
+    if key in _grouping_cache:
+        return _grouping_cache[key]
+    groups = []
+    short = 0
+    for g in basegroups:
+        candidates = []
         for u in range(g):
-            if onsets[u]:
-                p=beatfunc(onsets, g, u)
-                if p>s:
-                    s=p
-                    basegroup=g
-                    upbeat=u
+            beatno = (length-u)/g
+            if (length-u)%g==0:beatno-=1
+            if beatno<1:
+                # past the end of the sequence can't be checked
+                short |= 1 << u
+                continue
+            grid = 0
+            for p in range(u, length, g):
+                grid |= 1 << p
+            candidates.append((u, beatno, grid))
+        if candidates:
+            groups.append((g, min(c[1] for c in candidates), candidates))
+    _grouping_cache[key] = groups, short
+    return groups, short
+
+def best_grouping(mask, length, basegroups=(4,3)):
+    """returns the best grouping score of the onsets in bitmask mask, of
+    length pulses, and the basegroup and upbeat giving it, as found by
+    beat_metrics with calculate_beatscore, or a score of 0 if there is no
+    grouping.  Raises ValueError if there is an onset on the upbeat of a
+    grouping too short to analyse.
+
+    Scores can't be more than 1, or more than the number of onsets after
+    the first over the number of beats, so once the best score can't be
+    beaten, the remaining groupings, or all the upbeats of a basegroup,
+    are skipped without being scored"""
+    groups, short = _groupings(length, tuple(basegroups))
+    if mask & short or short >> length:
+        raise ValueError, "Sequence too short to correctly analyse"
+    others = bin(mask).count('1') - 1
+    s = 0
+    basegroup = upbeat = None
+    for g, least_beatno, candidates in groups:
+        if s >= 1.0: break
+        if 1.0*others/least_beatno <= s: continue
+        for u, beatno, grid in candidates:
+            if not mask >> u & 1: continue
+            p = 1.0*(bin(mask & grid).count('1') - 1)/beatno
+            if p > s:
+                s = p
+                basegroup = g
+                upbeat = u
+    return s, basegroup, upbeat
+
+def penalised_beatscore(onsets, s, basegroup, upbeat):
+    """returns beatscore from best grouping score s, for grouping in
+    basegroup with upbeat, rounded, and with penalties for upbeats"""
     # now set beatscore as best score
     beatscore=int(round(s*100,2))*1.0/100
     #subtract 0.1 for the presence of an upbeat
@@ -160,13 +800,369 @@ def beat_metrics(onsets, beatfunc=calculate_beatscore, debug=False):
     #check for confusing upbeat, and suptract 0.1 from beatscore if present
     if upbeat==0:
         if onsets[1] and not onsets[2]:beatscore-=0.1
-    if debug:
-        print "Score of",beatscore,", grouping in", basegroup,\
-              ", upbeat of",upbeat
+    return beatscore
+
+def incremental_beat_metrics(intervals, basegroups=(4,3)):
+    """Given some intervals, returns an iterator giving (intervals tuple,
+    metrics) for each distinct permutation of the intervals, in
+    lexicographic order, where metrics are the beatscore, basegroup and
+    upbeat from beat_metrics, or None if the permutation can't be analysed.
+
+    Successive permutations in lexicographic order only differ after the
+    interval that changes, so only the onsets after it are updated, along
+    with counts of onsets on the beats of each grouping."""
+    length=sum(intervals)
+    # upbeats past the end can't be scored, so the sequence can't be
+    # analysed if they are needed
+    groupings=[(g,u) for g in basegroups for u in range(min(g,length))]
+    short=[g for g in basegroups if g>length]
+    # number of beats after the first, for each grouping, as in
+    # calculate_beatscore
+    beatnos=[]
+    for g,u in groupings:
+        beatno=(length-u)/g
+        if (length-u)%g==0:beatno-=1
+        beatnos.append(beatno)
+    # groupings with a beat at each position
+    on_beat=[[k for k,(g,u) in enumerate(groupings) if p>=u and (p-u)%g==0]
+             for p in range(length)]
+    onsets=[0]*length
+    counts=[0]*len(groupings)
+    starts=[0]*(len(intervals)+1)
+    for L, changed in _lex_steps(intervals):
+        if short:
+            yield tuple(L), None
+            continue
+        # onsets from the start of the changed interval
+        pos=starts[changed]
+        for i in range(changed, len(L)):
+            starts[i]=pos
+            for p in range(pos, pos+L[i]):
+                o=p==pos and 1 or 0
+                if onsets[p]!=o:
+                    onsets[p]=o
+                    d=o and 1 or -1
+                    for k in on_beat[p]:
+                        counts[k]+=d
+            pos+=L[i]
+        # best grouping, as in beat_metrics
+        s=0
+        metrics=None
+        for k,(g,u) in enumerate(groupings):
+            if onsets[u]:
+                if beatnos[k]<1:
+                    s=0
+                    break
+                p=1.0*(counts[k]-1)/beatnos[k]
+                if p>s:
+                    s=p
+                    basegroup=g
+                    upbeat=u
+        if s>0:
+            metrics=(penalised_beatscore(onsets, s, basegroup, upbeat),
+                     basegroup, upbeat)
+        yield tuple(L), metrics
+
+def batch_calculate_beatscore(onsets, basegroup, upbeat):
+    """as calculate_beatscore, but for a 2D array of onsets, one
+    sequence per row, returning an array of scores"""
+    n = onsets.shape[1] - upbeat
+    beatno = n // basegroup
+    if n % basegroup == 0: beatno -= 1
+    if beatno < 1: raise ValueError, "Sequence too short to correctly analyse"
+    # Inevitable first onset brings beats to 0
+    beats = (onsets[:, upbeat::basegroup] != 0).sum(axis=1) - 1
+    return beats * 1.0 / beatno
+
+def batch_beat_metrics(onsets, beatfunc=batch_calculate_beatscore,
+                       basegroups=(4,3)):
+    """ Returns arrays of beatscore, basegroup and upbeat values for a
+    2D array of onsets, one sequence per row, following the same rules
+    as beat_metrics"""
+    onsets = np.asarray(onsets)
+    nseq = onsets.shape[0]
+    s = np.zeros(nseq)
+    basegroup = np.zeros(nseq, dtype=int)
+    upbeat = np.zeros(nseq, dtype=int)
+    for g in basegroups:
+        for u in range(g):
+            has_onset = onsets[:, u] != 0
+            if not has_onset.any(): continue
+            p = beatfunc(onsets, g, u)
+            better = has_onset & (p > s)
+            s = np.where(better, p, s)
+            basegroup[better] = g
+            upbeat[better] = u
+    if not basegroup.all(): raise ValueError, "No grouping found for sequence"
+    # now set beatscore as best score
+    beatscore = np.trunc(np.round(s*100, 2))*1.0/100
+    #subtract 0.1 for the presence of an upbeat
+    beatscore = np.where(upbeat > 0, beatscore-0.1, beatscore)
+    #upbeats of 3 in groups of 4, and upbeats of 2 in groups of 3
+    beatscore = np.where(upbeat == basegroup-1, beatscore-0.1, beatscore)
+    #confusing upbeat
+    confusing = (upbeat == 0) & (onsets[:, 1] != 0) & (onsets[:, 2] == 0)
+    beatscore = np.where(confusing, beatscore-0.1, beatscore)
     return beatscore, basegroup, upbeat
 
+def intervals_to_onset_array(intervals):
+    """converts a 2D array of intervals, one sequence per row, into a 2D
+    array of onsets"""
+    intervals = np.asarray(intervals, dtype=int)
+    nseq = intervals.shape[0]
+    starts = np.cumsum(intervals, axis=1) - intervals
+    onsets = np.zeros((nseq, intervals[0].sum()), dtype=np.int8)
+    onsets[np.arange(nseq)[:, None], starts] = 1
+    return onsets
+
+def window_index(onsets, beatscores, boi):
+    """returns a dictionary indexing the rows of a 2D onset array by
+    the bitmask of their onsets around the beat of interest (boi),
+    from boi-4 to boi+1
+
+    Values are arrays of the beatscores and row numbers for each
+    window, in order of beatscore, then row"""
+    windows = onsets[:, boi-4:boi+2] != 0
+    codes = windows.dot(1 << np.arange(windows.shape[1]))
+    order = np.lexsort((np.arange(len(codes)), beatscores, codes))
+    # split into runs of equal codes
+    starts = np.flatnonzero(np.diff(codes[order])) + 1
+    index = {}
+    for rows in np.split(order, starts):
+        if len(rows):
+            index[int(codes[rows[0]])] = (beatscores[rows], rows)
+    return index
+
+def onsets_to_bitmask(onsets):
+    """returns an integer with bit i set if there is an onset at position i"""
+    mask = 0
+    for i, o in enumerate(onsets):
+        if o: mask |= 1 << i
+    return mask
+
+def exclude_onsets(onsets):
+    """returns true if the onsets meet one of a few extra criteria for
+    exclusion from the metric simples, checking each complete bar of 4"""
+    exclude=False
+    #check for 13s and 121s
+    for i in range(0,len(onsets)-3,4):
+        if onsets[i:i+4]==[1,1,0,1]:exclude=True
+        if onsets[i:i+4]==[1,1,0,0]:exclude=True
+        #check for repeated 'bars' of 4
+        if i>=4 and onsets[i-4:i]==onsets[i:i+4]:exclude=True
+    return exclude
+
+def _excluded_bars(onsets, start, stop):
+    """returns true if a bar of 4 completed between onset lengths start
+    and stop meets one of the exclude_onsets criteria"""
+    for i in range(start-start%4,stop-3,4):
+        if start < i+4 <= stop:
+            if onsets[i:i+4]==[1,1,0,1]:return True
+            if onsets[i:i+4]==[1,1,0,0]:return True
+            if i>=4 and onsets[i-4:i]==onsets[i:i+4]:return True
+    return False
+
+def metric_arrangements(intervals, basegroup=4, upbeat=0,
+                        beatfunc=beat_metrics):
+    """Given some intervals, returns an iterator that gives each
+    arrangement of the intervals which forms a perfect metrically grouped
+    sequence, grouping in basegroup with given upbeat, and is not excluded
+    by exclude_onsets, looked up if beatfunc is a BeatTable.  Arrangements
+    are lists, in lexicographic order.
+
+    Arrangements are built an interval at a time, abandoning any partial
+    arrangement that misses an onset on a beat, has a confusing upbeat, or
+    completes an excluded bar, so most permutations are never visited.
+    Complete arrangements are checked with beatfunc.
+    """
+    values = sorted(set(intervals))
+    counts = [list(intervals).count(v) for v in values]
+    length = sum(intervals)
+    arrangement = []
+    onsets = []
+    exclude = exclude_function(beatfunc)
+
+    def place(pos):
+        if pos == length:
+            if not exclude(onsets) and \
+                    beatfunc(onsets) == (1.0, basegroup, upbeat):
+                yield arrangement[:]
+            return
+        # next position needing an onset
+        if pos < upbeat:
+            beat = upbeat
+        else:
+            beat = pos + basegroup - (pos - upbeat) % basegroup
+        for i, v in enumerate(values):
+            if beat < length and pos + v > beat: break
+            if not counts[i]: continue
+            # confusing upbeat
+            if upbeat == 0 and pos == 1 and v > 1: continue
+            counts[i] -= 1
+            arrangement.append(v)
+            onsets.extend([1] + [0]*(v-1))
+            if not _excluded_bars(onsets, pos, pos+v):
+                for a in place(pos+v):
+                    yield a
+            del onsets[pos:]
+            arrangement.pop()
+            counts[i] += 1
+
+    return place(0)
+
+def exclude_function(beatfunc):
+    """returns the function giving exclude_onsets results for sequences
+    analysed with beatfunc, looking them up if beatfunc is a BeatTable"""
+    if isinstance(beatfunc, BeatTable):
+        return beatfunc.exclude
+    return exclude_onsets
+
+# Beat tables are a 16 byte header, followed by one record for each onset
+# pattern of the table length, indexed by onset bitmask >> 1 (the first
+# onset is always present)
+BEAT_TABLE_MAGIC = 'BTAB'
+BEAT_TABLE_VERSION = 1
+BEAT_TABLE_HEADER = '<4sII4x'
+beat_table_dtype = np.dtype([('beatscore', '<f8'),
+                             ('basegroup', 'u1'),
+                             ('upbeat', 'u1'),
+                             ('flags', 'u1')])
+# flags
+BEAT_TABLE_VALID = 1
+BEAT_TABLE_EXCLUDE = 2
+
+def write_beat_table(filename, length):
+    """writes beat_metrics and exclude_onsets results for every onset
+    pattern of the given length to a beat table file"""
+    records = np.zeros(2**(length-1), dtype=beat_table_dtype)
+    for index in range(len(records)):
+        mask = index << 1 | 1
+        onsets = [(mask >> i) & 1 for i in range(length)]
+        try:
+            beatscore, basegroup, upbeat = beat_metrics(onsets)
+        except (ValueError, IndexError):
+            continue
+        flags = BEAT_TABLE_VALID
+        if exclude_onsets(onsets): flags |= BEAT_TABLE_EXCLUDE
+        records[index] = (beatscore, basegroup, upbeat, flags)
+    f = open(filename, 'wb')
+    f.write(struct.pack(BEAT_TABLE_HEADER, BEAT_TABLE_MAGIC,
+                        BEAT_TABLE_VERSION, length))
+    f.write(records.tostring())
+    f.close()
+
+class BeatTable(object):
+    ''' Memory mapped table of beat analysis results for all onset
+    patterns of one length, as written by write_beat_table
+
+    Can be used as the beatfunc of a Sequence, in this process; for pools
+    of workers, give the table filename to beatbatch.make_pool, which
+    opens the table in each worker
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        header_size = struct.calcsize(BEAT_TABLE_HEADER)
+        f = open(filename, 'rb')
+        magic, version, length = struct.unpack(BEAT_TABLE_HEADER,
+                                               f.read(header_size))
+        f.close()
+        if magic != BEAT_TABLE_MAGIC or version != BEAT_TABLE_VERSION:
+            raise ValueError, 'Not a beat table file: %s' % filename
+        self.length = length
+        self.records = np.memmap(filename, dtype=beat_table_dtype,
+                                 mode='r', offset=header_size,
+                                 shape=(2**(length-1),))
+
+    def lookup(self, onsets):
+        ''' returns the table record for onsets '''
+        if len(onsets) != self.length:
+            raise ValueError, 'Onsets must be of length %d' % self.length
+        if not onsets[0]:
+            raise ValueError, 'Onsets must start with 1'
+        record = self.records[onsets_to_bitmask(onsets) >> 1]
+        if not record['flags'] & BEAT_TABLE_VALID:
+            raise ValueError, 'Sequence cannot be analysed'
+        return record
+
+    def __call__(self, onsets, debug=False):
+        ''' Returns beatscore, basegroup and upbeat, as beat_metrics '''
+        if len(onsets) != self.length:
+            return beat_metrics(onsets, debug=debug)
+        record = self.lookup(onsets)
+        return (float(record['beatscore']), int(record['basegroup']),
+                int(record['upbeat']))
+
+    def exclude(self, onsets):
+        ''' Returns exclude_onsets result for onsets, calculated if the
+        table has no record for them '''
+        if len(onsets) != self.length or not onsets[0]:
+            return exclude_onsets(onsets)
+        record = self.records[onsets_to_bitmask(onsets) >> 1]
+        if not record['flags'] & BEAT_TABLE_VALID:
+            return exclude_onsets(onsets)
+        return bool(record['flags'] & BEAT_TABLE_EXCLUDE)
+
+    def batch_beat_metrics(self, onsets):
+        ''' Returns arrays of beatscore, basegroup and upbeat values for a
+        2D array of onsets, as batch_beat_metrics '''
+        onsets = np.asarray(onsets)
+        if onsets.shape[1] != self.length:
+            return batch_beat_metrics(onsets)
+        weights = 1 << np.arange(self.length)
+        records = self.records[(onsets != 0).dot(weights) >> 1]
+        if not (records['flags'] & BEAT_TABLE_VALID).all():
+            raise ValueError, 'Sequence cannot be analysed'
+        return (records['beatscore'], records['basegroup'].astype(int),
+                records['upbeat'].astype(int))
+
+class BeatAnalyser(object):
+    ''' Beat analysis as beat_metrics, grouping in any basegroups, for
+    sequences of any length
+
+    Can be used as the beatfunc of a Sequence
+    '''
+    def __init__(self, basegroups=(4,3)):
+        self.basegroups = tuple(basegroups)
+
+    def __call__(self, onsets, debug=False):
+        ''' Returns beatscore, basegroup and upbeat, as beat_metrics '''
+        return beat_metrics(onsets, debug=debug, basegroups=self.basegroups)
+
+    def batch_beat_metrics(self, onsets):
+        ''' Returns arrays of beatscore, basegroup and upbeat values for a
+        2D array of onsets, as batch_beat_metrics '''
+        return batch_beat_metrics(onsets, basegroups=self.basegroups)
+
+    def __eq__(self, other):
+        if not isinstance(other, BeatAnalyser):
+            return NotImplemented
+        return self.basegroups == other.basegroups
+
+    def __ne__(self, other):
+        if not isinstance(other, BeatAnalyser):
+            return NotImplemented
+        return self.basegroups != other.basegroups
+
+    def __hash__(self):
+        return hash(self.basegroups)
+
+    def __repr__(self):
+        return 'BeatAnalyser(%r)' % (self.basegroups,)
+
 class Sequence(object):
-    ''' Class for sequences of intervals '''
+    ''' Class for sequences of intervals
+
+    Onsets are stored as an integer bitmask and length, and intervals as
+    a tuple; beatscore, basegroup and upbeat are calculated when first
+    needed.  Permutations, metric sequences and matches are kept in the
+    analysis cache rather than on the sequence, so they are shared by
+    sequences with the same intervals, and count against its memory cap.
+    The cache holds their intervals, not sequences, and each call returns
+    new sequences, so callers cannot alter each other's results
+    '''
+    __slots__ = ('beatfunc', 'debug', '_mask', '_length', '_intervals',
+                 '_metrics')
+
     def __init__(self, sequence_def, beatfunc = beat_metrics, debug=False):
         ''' Initializes sequence from seqence_def
 
@@ -187,11 +1183,13 @@ class Sequence(object):
         self.beatfunc = beatfunc
         self.debug = debug
         self._initialize(sequence_def)
+        if instrumentation is not None:instrumentation.count('sequences')
 
     def set_onsets(self, onsets):
         self._initialize(onsets, 'onsets')
     def get_onsets(self):
-        return self._onsets
+        mask = self._mask
+        return [(mask >> i) & 1 for i in range(self._length)]
     onsets = property(get_onsets, 
                       set_onsets, 
                       None, 
@@ -200,24 +1198,42 @@ class Sequence(object):
     def set_intervals(self, intervals):
         self._initialize(intervals, 'intervals')
     def get_intervals(self):
-        return self._intervals
+        return list(self._intervals)
     intervals = property(get_intervals, 
                         set_intervals, 
                         None, 
                         'get/set intervals');
+
+    def get_bitmask(self):
+        return self._mask
+    bitmask=property(get_bitmask,None,None,'get onsets as integer bitmask')
     
     def get_beatscore(self):
-        return self._beatscore
+        return self._get_metrics()[0]
     beatscore=property(get_beatscore,None,None,'get beatscore')
 
     def get_upbeat(self):
-        return self._upbeat
+        return self._get_metrics()[2]
     upbeat=property(get_upbeat,None,None,'get upbeat')
 
     def get_basegroup(self):
-        return self._basegroup
+        return self._get_metrics()[1]
     basegroup=property(get_basegroup,None,None,'get basegroup')
 
+    def _get_metrics(self):
+        ''' returns beatscore, basegroup and upbeat, calculating if
+        necessary '''
+        if self._metrics is None:
+            key = ('beat_metrics', self.beatfunc, self._mask, self._length)
+            metrics = analysis_cache.get(key)
+            if metrics is None:
+                if instrumentation is not None:
+                    instrumentation.count('beatfunc calls')
+                metrics = self.beatfunc(self.onsets)
+                analysis_cache.put(key, metrics)
+            self._metrics = metrics
+        return self._metrics
+
     def _intervals_to_onsets(self, intervals):
         ''' Convert intervals to onsets '''
         onsets = []
@@ -241,20 +1257,78 @@ class Sequence(object):
                 raise ValueError, 'Must be 0 or 1 onsets'
         return intervals
 
+    def iter_permutations(self):
+        ''' iterates over all the distinct permutations of the sequence,
+        in lexicographic order of intervals, without caching them '''
+        if self.beatfunc is beat_metrics:
+            basegroups = (4,3)
+        elif isinstance(self.beatfunc, BeatAnalyser):
+            basegroups = self.beatfunc.basegroups
+        else:
+            for intervals in multiset_permutations(self.intervals):
+                if instrumentation is not None:
+                    instrumentation.count('permutations')
+                yield Sequence(intervals, self.beatfunc)
+            return
+        # score permutations as they are made
+        for intervals, metrics in incremental_beat_metrics(self.intervals,
+                                                           basegroups):
+            if instrumentation is not None:
+                instrumentation.count('permutations')
+            seq = Sequence(list(intervals), self.beatfunc)
+            seq._metrics = metrics
+            yield seq
+
     def all_permutations(self):
-        ''' returns a list of all the possible permutations of the sequence
+        ''' returns a list of all the distinct permutations of the sequence,
+        in lexicographic order of intervals
 
-        Caches result, only invalidated by onset, interval get/set
+        Intervals and metrics of the permutations are cached in the
+        analysis cache, and new sequences made from them for each call
         '''
-        if self._all_permutations is None:
-            L = []
-            S = []
-            for intervals in permIter(self.intervals):
-                if intervals not in L:
-                    L.append(intervals)
-                    S.append(Sequence(intervals))
-            self._all_permutations = S
-        return self._all_permutations
+        key = ('all_permutations', self.beatfunc,
+               tuple(sorted(self._intervals)))
+        S = analysis_cache.get(key)
+        if S is None:
+            made = [(seq._intervals, seq._metrics)
+                    for seq in self.iter_permutations()]
+            S = (tuple(i for i, m in made), tuple(m for i, m in made))
+            analysis_cache.put(key, S)
+        return self._make_sequences(S[0], S[1])
+
+    def scored_permutations(self):
+        ''' returns 2D arrays of intervals and onsets for all the distinct
+        permutations of the sequence (in the same order as all_permutations),
+        along with arrays of their beatscores, basegroups and upbeats
+
+        Result is cached in the analysis cache
+        '''
+        key = ('permutations', self.beatfunc, tuple(sorted(self._intervals)))
+        scored = analysis_cache.get(key)
+        if scored is None:
+            inst = instrumentation
+            if inst is not None:start = time.time()
+            intervals = np.array(list(multiset_permutations(self.intervals)))
+            onsets = intervals_to_onset_array(intervals)
+            if isinstance(self.beatfunc, (BeatTable, BeatAnalyser)):
+                scores = self.beatfunc.batch_beat_metrics(onsets)
+            elif self.beatfunc is beat_metrics:
+                scores = batch_beat_metrics(onsets)
+            else:
+                rows = [self.beatfunc(row.tolist()) for row in onsets]
+                scores = [np.array(v) for v in zip(*rows)]
+                if inst is not None:
+                    inst.count('beatfunc calls', len(rows))
+            scored = (intervals, onsets) + tuple(scores)
+            # shared through the cache, so make read only
+            for a in scored:
+                a.flags.writeable = False
+            analysis_cache.put(key, scored)
+            if inst is not None:
+                inst.count('permutations', len(intervals))
+                inst.add_time('permutation', time.time()-start,
+                              self._intervals)
+        return scored
 
     def _initialize(self, sequence_def, def_type=None):
         ''' Sets onsets, intervals,  beatscore, basegroup and upbeat attributes, '''
@@ -270,118 +1344,228 @@ class Sequence(object):
             else:
                 def_type = 'intervals'
         if def_type == 'intervals':
-            self._intervals = sequence_def
-            self._onsets = self._intervals_to_onsets(sequence_def)
+            self._intervals = tuple(sequence_def)
         elif def_type == 'onsets':
             if len(sequence_def) and sequence_def[0] == 0:
                 raise ValueError, 'Onsets must start with 1'
-            self._onsets = sequence_def
-            self._intervals = self._onsets_to_intervals(sequence_def)
+            self._intervals = tuple(self._onsets_to_intervals(sequence_def))
         else:
             raise ValueError, 'Strange sequence definition %s' % def_type
+        self._mask = 0
+        self._length = 0
+        for e in self._intervals:
+            self._mask |= 1 << self._length
+            self._length += e
 
-        # Clear cached variables for lazy loading
-        self._all_permutations = None
-        self._all_metric = None
-        self._matched_complex = None
+        # Clear cached metrics for lazy loading
+        self._metrics = None
 
-        # Calculate beatscore etc
-        self._beatscore, self._basegroup, self._upbeat = self.beatfunc(
-            self.onsets)
+    def _make_sequences(self, interval_list, metrics_list=None):
+        ''' returns list of new sequences from list of intervals, sharing
+        the same sequence for repeated intervals, with metrics from
+        metrics_list if given '''
+        made={}
+        S=[]
+        for n, intervals in enumerate(interval_list):
+            if intervals not in made:
+                seq=Sequence(list(intervals), self.beatfunc)
+                if metrics_list is not None:seq._metrics=metrics_list[n]
+                made[intervals]=seq
+            S.append(made[intervals])
+        return S
 
     def all_metric(self,basegroup=4,upbeat=0):
         """returns a list of all possible re-arrangements of the sequence
-        which form a perfect metrically grouped sequence"""
-        if self._all_metric:
-            return self._all_metric
-        L=self.all_permutations()
-        S=[]
-        for i in L:
-            if i.beatscore==1.0 and i.basegroup==basegroup \
-                   and i.upbeat==upbeat and i.extra_exclude()==False:
-                S.append(i)
-        self._all_metric = S
-        return S
+        which form a perfect metrically grouped sequence
+
+        Intervals of the result are cached in the analysis cache, and new
+        sequences made from them for each call"""
+        key = ('all_metric', self.beatfunc, tuple(sorted(self._intervals)),
+               basegroup, upbeat)
+        S = analysis_cache.get(key)
+        if S is None:
+            inst = instrumentation
+            if inst is not None:start = time.time()
+            S = self._find_metric(basegroup, upbeat)
+            analysis_cache.put(key, S)
+            if inst is not None:
+                inst.add_time('metric filtering', time.time()-start,
+                              self._intervals)
+        return self._make_sequences(S)
+
+    def _find_metric(self, basegroup, upbeat):
+        ''' returns tuple of intervals of metric sequences for all_metric '''
+        if self.beatfunc is beat_metrics or \
+                isinstance(self.beatfunc, (BeatTable, BeatAnalyser)):
+            return tuple(tuple(a) for a in metric_arrangements(
+                self.intervals, basegroup, upbeat, self.beatfunc))
+        intervals, onsets, beatscores, basegroups, upbeats = \
+            self.scored_permutations()
+        mask = (beatscores==1.0) & (basegroups==basegroup) & \
+            (upbeats==upbeat)
+        exclude = exclude_function(self.beatfunc)
+        return tuple(tuple(intervals[i].tolist())
+                     for i in np.flatnonzero(mask)
+                     if not exclude(onsets[i].tolist()))
+
     def extra_exclude(self):
         """returns true if the sequence meets one of a few extra criteria for
         exclusion from the metric simples"""
-        exclude=False
-        #check for 13s and 121s
-        for i in range(0,12,4):
-            if self.onsets[i:i+4]==[1,1,0,1]:exclude=True
-            if self.onsets[i:i+4]==[1,1,0,0]:exclude=True
-        #check for repeated 'bars' of 4
-        if self.onsets[0:4]==self.onsets[4:8] or \
-                self.onsets[4:8]==self.onsets[8:12]:exclude=True
-        return exclude
+        return exclude_function(self.beatfunc)(self.onsets)
 
     def matched_complex(self,bois=[9,5],threshold=0.8):
         """returns a list of sequences with a beatscore lower than or 
         equal to threshold, re-arrangements of the given sequence, 
-        which match the given sequence around the beat of interest (boi)"""
-        if self._matched_complex:
-            return self._matched_complex, self._boilist
-        L=self.all_permutations()
-        S=[]
-        boidict={}
-        for boi in bois:
-            if boi<=4 or boi>=(len(self.onsets)-1):raise ValueError , \
-                "beat of interest invalid for sequence"
-            for i in L:
-                if i.onsets[boi-4:boi+2]==self.onsets[boi-4:boi+2] \
-                        and i.beatscore<=threshold:
-                    S.append(i)
-                    boidict[i]=boi
-        S.sort(lambda x, y: cmp(x.beatscore, y.beatscore))
-        boilist=[]
-        for i in S:
-            boilist.append(boidict[i])
+        which match the given sequence around the beat of interest (boi)
+
+        Matches are in order of beatscore.  Matches with equal beatscores
+        are in the order of bois, and those for the same boi in
+        lexicographic order of intervals, the order of all_permutations.
+        A match found for more than one boi is given its last boi.
+        Caches result for each bois and threshold"""
+        return self._matched_complex_for(bois, threshold)
+
+    def matched_complex_sweep(self, settings):
+        """returns a dictionary of matched_complex results, keyed by
+        (bois tuple, threshold), for a sequence of (bois, threshold)
+        settings"""
+        results={}
+        for bois, threshold in settings:
+            results[tuple(bois), threshold] = self._matched_complex_for(
+                bois, threshold)
+        return results
+
+    def window_index(self, boi):
+        ''' returns window_index of all permutations of the sequence
+        around the beat of interest (boi)
+
+        The index is shared by all sequences with the same intervals,
+        through the analysis cache
+        '''
+        if boi<=4 or boi>=(len(self.onsets)-1):raise ValueError , \
+            "beat of interest invalid for sequence"
+        key = ('window_index', self.beatfunc, tuple(sorted(self._intervals)),
+               boi)
+        index = analysis_cache.get(key)
+        if index is None:
+            intervals, onsets, beatscores, basegroups, upbeats = \
+                self.scored_permutations()
+            index = window_index(onsets, beatscores, boi)
+            analysis_cache.put(key, index)
+        return index
+
+    def _matched_complex_for(self, bois, threshold):
+        ''' returns matched_complex result, cached in the analysis cache
+        for bois and threshold '''
+        key = ('matched_complex', self.beatfunc, self._intervals,
+               tuple(bois), threshold)
+        matched = analysis_cache.get(key)
+        if matched is None:
+            inst = instrumentation
+            if inst is not None:start = time.time()
+            matched = self._find_matched_complex(bois, threshold)
+            analysis_cache.put(key, matched)
+            if inst is not None:
+                inst.add_time('matching', time.time()-start, self._intervals)
+        S = self._make_sequences(matched[0])
+        boilist = list(matched[1])
 
         if self.debug:
             if len(S)>0:print "Best one:",S[0].intervals,"\n",len(S),"found"
             else: print "None found"
-        self._matched_complex = S
-        self._boilist=boilist
         return S, boilist
 
-    def wrong_version(self,debug=False):
+    def _find_matched_complex(self, bois, threshold):
+        ''' returns tuples of intervals and bois for matched_complex '''
+        intervals = self.scored_permutations()[0]
+        L=[]
+        for boi in bois:
+            index = self.window_index(boi)
+            code = onsets_to_bitmask(self.onsets[boi-4:boi+2])
+            if code not in index: continue
+            beatscores, rows = index[code]
+            n = beatscores.searchsorted(threshold, 'right')
+            L += zip(beatscores[:n], rows[:n], [boi]*n)
+        # stable sort on beatscore, keeping bois in order
+        L.sort(key=lambda x: x[0])
+        # repeated matches take the boi of their last match, as a
+        # sequence can only have one boi
+        last_boi={}
+        for score, n, boi in L:
+            last_boi[n]=boi
+        return (tuple(tuple(intervals[n].tolist()) for score, n, boi in L),
+                tuple(last_boi[n] for score, n, boi in L))
+
+    def iter_matched_complex(self, bois=[9,5], threshold=0.8):
+        """iterates over (sequence, boi) for the matches of matched_complex,
+        in the same order, finding each only as it is asked for.
+
+        The matches for each boi are already in order of beatscore in the
+        window index, so they are merged with a heap rather than sorted"""
+        intervals, onsets = self.scored_permutations()[:2]
+        codes = []
+        streams = []
+        for b, boi in enumerate(bois):
+            index = self.window_index(boi)
+            code = onsets_to_bitmask(self.onsets[boi-4:boi+2])
+            codes.append((boi, code))
+            if code not in index: continue
+            beatscores, rows = index[code]
+            n = beatscores.searchsorted(threshold, 'right')
+            streams.append(itertools.izip(beatscores[:n], itertools.repeat(b),
+                                          rows[:n]))
+        made = {}
+        for score, b, n in heapq.merge(*streams):
+            if n not in made:
+                made[n] = Sequence(intervals[n].tolist(), self.beatfunc)
+            # as in matched_complex, the boi of the last match of the row
+            # (all its matches have the same beatscore, so come together)
+            last_boi = bois[b]
+            for boi, code in codes[b+1:]:
+                if onsets_to_bitmask(onsets[n, boi-4:boi+2]) == code:
+                    last_boi = boi
+            yield made[n], last_boi
+
+    def wrong_versions(self):
+        """returns a list of all the sequences which differ from the input
+        by joining two intervals (but not the last two) into an interval
+        of at most 4, then splitting one interval into two.
+        metric/complex is preserved.
+
+        Sequences are in order of join position, split position, then
+        size of first part of the split"""
+        S=[]
+        seen=set([self._intervals])
+        intervals=self._intervals
+        for pos in range(len(intervals)-2):
+            newinterval=intervals[pos]+intervals[pos+1]
+            if newinterval>4:continue # don't make intervals greater than 4
+            joined=intervals[:pos]+(newinterval,)+intervals[pos+2:]
+            for split_pos,n in enumerate(joined):
+                for split1 in range(n-1,0,-1):
+                    new=joined[:split_pos]+(split1,n-split1)+\
+                        joined[split_pos+1:]
+                    if new in seen:continue
+                    seen.add(new)
+                    newsequence=Sequence(list(new), self.beatfunc)
+                    if self.beatscore==1.0 and newsequence.beatscore!=1.0:
+                        continue
+                    if self.beatscore<=0.8 and newsequence.beatscore>0.8:
+                        continue
+                    S.append(newsequence)
+        return S
+
+    def wrong_version(self,debug=False,rng=random):
         """returns another sequence which differs from the input by
         joining two intervals, and splitting one interval into two.
-        metric/complex is preserved"""
-        #loop until one is found which fits criteria
-        found=False
-        num=0 # used to raise an error if too many loops occur
-        while found==False:
-            num+=1
-            if num>=1000:raise ValueError,"no possible wrong version"
-            newsequence=Sequence(self.intervals[:])
-            #choose random position to join
-            pos=random.randint(0,len(newsequence.intervals)-3)
-            if debug:print "position:",pos
-            newinterval=newsequence.intervals[pos]+newsequence.intervals[pos+1]
-            if newinterval>4:continue # don't make intervals greater than 4
-            newsequence.intervals[pos:pos+2]=[newinterval]
-            if debug:print "join gives:",newsequence
-            #now a random split
-            pos=random.randint(0,len(newsequence.intervals)-1)
-            if debug:print "split at:",pos
-            n=newsequence.intervals[pos]
-            if n==1:continue # can't split a 1
-            split=random.randint(1,n-1)
-            split1=n-split
-            split2=n-split1
-            if debug:print "splitting",n,"to",split1,"and",split2
-            newsequence.intervals[pos]=split1
-            if debug:print newsequence
-            newsequence.intervals[pos+1:pos+1]=[split2]
-            #now check that new sequence is similar to self (but not same)
-            if debug:print newsequence
-            if debug:print self.intervals
-            found=True
-            if newsequence.intervals==self.intervals:found=False
-            if self.beatscore==1.0 and newsequence.beatscore!=1.0:found=False
-            if self.beatscore<=0.8 and newsequence.beatscore>0.8:found=False
-        return newsequence
+        metric/complex is preserved.
+
+        The sequence is chosen at random from wrong_versions, using rng,
+        which can be a seeded random.Random instance"""
+        S=self.wrong_versions()
+        if debug:print len(S),"possible wrong versions of",self
+        if not S:raise ValueError,"no possible wrong version"
+        return rng.choice(S)
 
     def __str__(self):
         intervalstring=""
@@ -389,10 +1573,131 @@ class Sequence(object):
             intervalstring+=str(i)
         return intervalstring
 
+    def __eq__(self, other):
+        if not isinstance(other, Sequence):
+            return NotImplemented
+        return self._intervals == other._intervals
+
+    def __ne__(self, other):
+        if not isinstance(other, Sequence):
+            return NotImplemented
+        return self._intervals != other._intervals
+
+    def __hash__(self):
+        return hash(self._intervals)
+
+def choose_wrong_version(seq, rng=random, used=None):
+    """returns a wrong version of seq chosen at random with rng, avoiding
+    those in the set used, and adding the one chosen to it.  Returns None
+    if there is no unused wrong version"""
+    if used is None:
+        used=set()
+    candidates=[w for w in seq.wrong_versions() if w not in used]
+    if not candidates:
+        return None
+    wrong=rng.choice(candidates)
+    used.add(wrong)
+    return wrong
+
+def unique_wrong_versions(sequences, seed=None, used=None, missing=False):
+    """returns a list with a wrong version of each of sequences, chosen at
+    random, with no wrong version used twice.  Wrong versions in the set
+    used are also avoided, and the set is updated with those chosen.
+    If a sequence has no unused wrong version, raises a ValueError, or,
+    if missing is true, gives None for that sequence.
+
+    Choices are repeatable for a given seed"""
+    rng=random.Random(seed)
+    if used is None:
+        used=set()
+    S=[]
+    for seq in sequences:
+        wrong=choose_wrong_version(seq, rng, used)
+        if wrong is None and not missing:
+            raise ValueError, "no unused wrong version of %s" % seq
+        S.append(wrong)
+    return S
+
+class LazyMatches(object):
+    ''' Matches and bois from an iterator of (match, boi) pairs, taken
+    from the iterator only as they are needed '''
+    def __init__(self, pairs):
+        self._pairs = iter(pairs)
+        self.matches = []
+        self.boilist = []
+
+    def fetch(self, n):
+        """takes pairs until there are at least n, or none left.
+        Returns true if there are at least n"""
+        while len(self.matches) < n and self._pairs is not None:
+            try:
+                match, boi = self._pairs.next()
+            except StopIteration:
+                self._pairs = None
+                break
+            self.matches.append(match)
+            self.boilist.append(boi)
+        return len(self.matches) >= n
+
+    def fetch_all(self):
+        self.fetch(sys.maxint)
+
+class LazyColumn(object):
+    ''' List-like view of the matches or bois of LazyMatches '''
+    def __init__(self, lazy, name):
+        self._lazy = lazy
+        self._name = name
+
+    def _values(self):
+        return getattr(self._lazy, self._name)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            if item.stop is None or item.stop < 0 or \
+                    (item.start or 0) < 0:
+                self._lazy.fetch_all()
+            else:
+                self._lazy.fetch(item.stop)
+        elif item < 0:
+            self._lazy.fetch_all()
+        else:
+            self._lazy.fetch(item+1)
+        return self._values()[item]
+
+    def __len__(self):
+        self._lazy.fetch_all()
+        return len(self._values())
+
+    def __nonzero__(self):
+        return self._lazy.fetch(1)
+
+    def __iter__(self):
+        n = 0
+        while self._lazy.fetch(n+1):
+            yield self._values()[n]
+            n += 1
+
 class MatchedSequence(object):
-    def __init__(self, target_sequence):
+    ''' Target sequence with its matched complex sequences, and the one
+    preferred
+
+    If lazy, matches are only found as they are asked for, in the same
+    order, and matches and boilist are list-like views of those found.
+    Matches can also be given as an iterable of (match, boi) pairs, which
+    are taken lazily '''
+    def __init__(self, target_sequence, lazy=False, pairs=None,
+                 bois=[9,5], threshold=0.8):
         self.target_sequence = target_sequence
-        self.matches, self.boilist = target_sequence.matched_complex()
+        if lazy and pairs is None:
+            pairs = target_sequence.iter_matched_complex(bois, threshold)
+        if pairs is not None:
+            self._lazy = LazyMatches(pairs)
+            self.matches = LazyColumn(self._lazy, 'matches')
+            self.boilist = LazyColumn(self._lazy, 'boilist')
+        else:
+            self._lazy = None
+            self.matches, self.boilist = target_sequence.matched_complex(
+                bois, threshold)
         self._preferred_match_no = 0
 
     def get_preferred_match(self):
@@ -404,8 +1709,21 @@ class MatchedSequence(object):
     preferred_match = property(get_preferred_match)
     preferred_match_no=property(get_preferred_match_no,set_preferred_match_no)
 
+    def has_match(self, n):
+        """returns true if there is a match number n"""
+        if self._lazy is not None:
+            return self._lazy.fetch(n+1)
+        return n < len(self.matches)
+
+    def first_matches(self, n):
+        """returns list of the first n matches, or all if fewer"""
+        if self._lazy is not None:
+            self._lazy.fetch(n)
+            return self._lazy.matches[:n]
+        return self.matches[:n]
+
     def to_next_match(self):
-        if self._preferred_match_no >= len(self.matches)-1:
+        if not self.has_match(self._preferred_match_no+1):
             raise ValueError, 'Ran out of matches, leaving as was'
         self._preferred_match_no += 1
         
@@ -419,46 +1737,118 @@ class MatchedSequence(object):
 
 
 class MatchedSequenceCollection(object):
-    ''' Collection of previously matched sequences '''
+    ''' Collection of previously matched sequences
+
+    Preferred matches are kept as an Assignment of matches to sequences,
+    with the match number as the cost, updated by one augmenting path for
+    each sequence added '''
     def __init__(self, matched_seq_list=None):
         if matched_seq_list is None:
             matched_seq_list = []
         self.collection = matched_seq_list
-        
-    def append_attempt(self,mseq):
-        #make fallback copy
-        collection_copy=copy.deepcopy(self.collection)
-        #add new sequence
-        self.collection.append(mseq)
-        #create list of how many matches each has
-        totalmatcheslist=[]
-        for i in self.collection:
-            totalmatcheslist.append(len(i.matches))
-        #go through these possibilites, check for duplicates
-        for matcheslist in valueperm(totalmatcheslist):
-            #set the preferred matches to those corresponding to this set
-            for i,m in enumerate(matcheslist):
-                self.collection[i].preferred_match_no=m-1
-            #now check for duplicates
-            failure=False
-            checklist=[]
-            for match in self.collection:
-                if match.preferred_match.intervals not in checklist:
-                    checklist.append(match.preferred_match.intervals)
-                else:
-                    failure=True
+        self._assignment = None
+        # match numbers less than this are in the assignment
+        self._limit = 0
+
+    def _options(self, mseq, start):
+        """returns options for the assignment of matches of mseq from
+        match number start up to the limit"""
+        if start >= self._limit or not mseq.has_match(start):
+            return []
+        return [(n, tuple(m.intervals)) for n, m in
+                enumerate(mseq.first_matches(self._limit)[start:], start)]
+
+    def _current_assignment(self):
+        """returns the assignment, made again from the preferred matches
+        if the collection was changed other than by append_attempt"""
+        a = self._assignment
+        if a is not None and len(a.choice) == len(self.collection):
+            for ch, mseq in zip(a.choice, self.collection):
+                if ch is not None and ch[2] != mseq.preferred_match_no:
                     break
-            if failure==True:
-                continue
-            else: 
-                break
-        #if ends naturally, not possible to add it in, so revert to copy
-        #and raise an error
-        else:
-            self.collection=collection_copy
-            raise ValueError, "Can't be put in"
+            else:
+                return a
+        for mseq in self.collection:
+            self._limit = max(self._limit, mseq.preferred_match_no+1)
+        a = Assignment()
+        for mseq in self.collection:
+            t = a.add_target(self._options(mseq, 0))
+            a.assign(t, mseq.preferred_match_no)
+        # sequences whose preferred match was already taken, or isn't one
+        # of their options, are given matches again
+        free = [t for t, ch in enumerate(a.choice) if ch is None]
+        for t in free:
+            self._augmenting_path(a, t)
+        self._assignment = a
+        return a
 
+    def _set_preferred(self, a):
+        """sets the preferred match of each sequence from assignment a,
+        which can change sequences off the last augmenting path"""
+        for mseq, ch in zip(self.collection, a.choice):
+            if ch is not None:
+                mseq.preferred_match_no = ch[2]
 
+    def append_attempt(self,mseq):
+        """adds mseq to the collection, reassigning preferred matches so
+        that no two sequences share a preferred match, keeping the total of
+        the preferred match numbers as low as possible
 
+        If mseq can't be added, raises a ValueError, leaving the collection
+        as it was"""
+        inst = instrumentation
+        if inst is not None:start = time.time()
+        a = self._current_assignment()
+        self.collection.append(mseq)
+        start = a.add_target()
+        if None in a.choice[:start]:
+            # sequences already in the collection can't all have matches
+            path = None
+        else:
+            path = self._augmenting_path(a, start)
+        if inst is not None:
+            inst.count('append attempts')
+            inst.add_time('assignment', time.time()-start,
+                          mseq.target_sequence._intervals)
+            if path is None:
+                inst.count('append failures')
+            else:
+                # other sequences giving up their preferred match
+                inst.count('backtracks', len(path)-1)
+        if path is None:
+            a.remove_last()
+            self.collection.pop()
+            raise ValueError, "Can't be put in"
+        self._set_preferred(a)
 
+    def _augmenting_path(self, a, start):
+        """takes the cheapest augmenting path giving the sequence at index
+        start a match in assignment a, returning the changes to preferred
+        matches as a list of (sequence index, match number), or None if
+        there is no path
 
+        Only the first matches of each sequence are in the assignment at
+        first, as lazy sequences find matches as they are asked for.  If a
+        path using a later match could be cheaper than the best found,
+        more are added."""
+        # a path can't cost less than its largest match number, less the
+        # preferred match numbers given up
+        refund = sum(ch[1] for ch in a.choice if ch is not None)
+        self._limit = max(self._limit, refund + 8)
+        while True:
+            for t, mseq in enumerate(self.collection):
+                a.add_options(t, self._options(mseq, a.noptions[t]))
+            if instrumentation is not None:
+                instrumentation.count('path searches')
+            complete = True
+            for mseq in self.collection:
+                if mseq.has_match(self._limit):
+                    complete = False
+                    break
+            max_cost = None
+            if not complete:
+                max_cost = self._limit - refund
+            found = a.augment([start], max_cost)
+            if complete or (found is not None and found[0] < max_cost):
+                return found and found[1]
+            self._limit *= 2
@@ -0,0 +1,293 @@
+#!/bin/env python
+'''
+Long running analysis server, keeping permutations, beat scores and
+matches warm in the analysis caches of its workers between requests.
+
+Clients connect over a Unix socket or localhost TCP, and send requests as
+lines of JSON, each a request object or a list of them, getting a line
+of JSON back for each line sent, with a response object, or list of
+them, in the same order.  A request object has an 'op' naming the
+analysis, an optional 'id' which is copied to the response, and the
+arguments of the analysis:
+
+  sequence         sequence -> intervals, onsets, beatscore, basegroup,
+                   upbeat
+  all_metric       sequence, basegroup=4, upbeat=0 -> sequences
+  matched_complex  sequence, bois=[9,5], threshold=0.8 -> sequences,
+                   beatscores, bois
+  getmatches       intervals, bois=[9,5], threshold=0.8, optimal=false ->
+                   records, as beatbatch.match_records
+  findmatches      intervals, bois=[9,5], threshold=0.8 -> records
+  wrong_version    sequence, seed=null -> sequence, or null if there is
+                   no wrong version
+  stats            -> analysis cache statistics of each worker
+  ping             -> nothing
+
+Sequences are strings or lists, as for beatsequence.Sequence, and are
+returned as strings.  A request that fails gets a response with an
+'error' message instead.
+
+Requests are run by a pool of worker processes.  Each request goes to the
+worker for the multiset of its intervals, so analyses of re-arrangements
+of the same intervals share a warm cache, and requests in a list, or
+from concurrent clients, run in parallel on different workers
+'''
+
+import json
+import multiprocessing
+import os
+import random
+import socket
+import SocketServer
+
+import beatsequence as BS
+import beatbatch
+
+def _sequence_result(seq):
+    return {'sequence': str(seq),
+            'intervals': seq.intervals,
+            'onsets': seq.onsets,
+            'beatscore': float(seq.beatscore),
+            'basegroup': int(seq.basegroup),
+            'upbeat': int(seq.upbeat)}
+
+def _sequence(request):
+    return _sequence_result(BS.Sequence(request['sequence'],
+                                        beatbatch.beatfunc))
+
+def _all_metric(request):
+    seq = BS.Sequence(request['sequence'], beatbatch.beatfunc)
+    metrics = seq.all_metric(request.get('basegroup', 4),
+                             request.get('upbeat', 0))
+    return {'sequences': [str(s) for s in metrics]}
+
+def _matched_complex(request):
+    seq = BS.Sequence(request['sequence'], beatbatch.beatfunc)
+    matched, bois = seq.matched_complex(request.get('bois', [9,5]),
+                                        request.get('threshold', 0.8))
+    return {'sequences': [str(m) for m in matched],
+            'beatscores': [float(m.beatscore) for m in matched],
+            'bois': bois}
+
+def _match_records(request, method):
+    return {'records': beatbatch.match_records(
+        list(request['intervals']), method,
+        request.get('bois', [9,5]), request.get('threshold', 0.8),
+        request.get('optimal', False))}
+
+def _getmatches(request):
+    return _match_records(request, 'getmatches')
+
+def _findmatches(request):
+    if request.get('optimal', False):
+        raise ValueError, 'findmatches has no optimal assignment'
+    return _match_records(request, 'findmatches')
+
+def _wrong_version(request):
+    seq = BS.Sequence(request['sequence'], beatbatch.beatfunc)
+    rng = random.Random(request.get('seed'))
+    try:
+        return {'sequence': str(seq.wrong_version(rng=rng))}
+    except ValueError:
+        return {'sequence': None}
+
+def _stats(request):
+    return {'pid': os.getpid(), 'cache': BS.analysis_cache.stats()}
+
+def _ping(request):
+    return {}
+
+operations = {'sequence': _sequence,
+              'all_metric': _all_metric,
+              'matched_complex': _matched_complex,
+              'getmatches': _getmatches,
+              'findmatches': _findmatches,
+              'wrong_version': _wrong_version,
+              'stats': _stats,
+              'ping': _ping}
+
+def handle_request(request):
+    """returns response dictionary for request dictionary, run in the
+    calling process"""
+    try:
+        if not isinstance(request, dict):
+            raise ValueError, 'Request must be a JSON object'
+        op = request.get('op')
+        if op not in operations:
+            raise ValueError, 'Unknown operation %s' % op
+        response = operations[op](request)
+    except Exception, e:
+        response = {'error': '%s: %s' % (e.__class__.__name__, e)}
+    if isinstance(request, dict) and 'id' in request:
+        response['id'] = request['id']
+    return response
+
+def multiset_of(request):
+    """returns sorted tuple of the intervals of request, or None if it has
+    none"""
+    if not isinstance(request, dict):
+        return None
+    try:
+        if 'intervals' in request:
+            return tuple(sorted(request['intervals']))
+        if 'sequence' in request:
+            return tuple(sorted(BS.Sequence(request['sequence']).intervals))
+    except (ValueError, TypeError):
+        pass
+    return None
+
+class AnalysisServer(object):
+    ''' Worker processes, each with its own warm analysis cache, running
+    requests for the multisets given to it '''
+    def __init__(self, workers=None, max_bytes=None, beat_table=None):
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.pools = [beatbatch.make_pool(1, max_bytes, beat_table)
+                      for n in range(workers)]
+
+    def pool_for(self, request):
+        """returns the pool of the worker for request"""
+        multiset = multiset_of(request)
+        if multiset is None:
+            return self.pools[0]
+        return self.pools[hash(multiset) % len(self.pools)]
+
+    def _get(self, result, request):
+        """returns response from result of a request, or an error response
+        if the worker could not return one"""
+        try:
+            return result.get()
+        except Exception, e:
+            response = {'error': '%s: %s' % (e.__class__.__name__, e)}
+            if isinstance(request, dict) and 'id' in request:
+                response['id'] = request['id']
+            return response
+
+    def run(self, requests):
+        """returns list of responses to list of requests, run in parallel
+        by their workers"""
+        results = []
+        for request in requests:
+            if isinstance(request, dict) and request.get('op') == 'stats':
+                results.append([pool.apply_async(handle_request, (request,))
+                                for pool in self.pools])
+            else:
+                results.append(self.pool_for(request).apply_async(
+                    handle_request, (request,)))
+        responses = []
+        for request, result in zip(requests, results):
+            if isinstance(result, list):
+                workers = [self._get(r, request) for r in result]
+                response = {'workers': workers}
+                if 'id' in request:
+                    response['id'] = request['id']
+                    for w in workers: w.pop('id', None)
+                responses.append(response)
+            else:
+                responses.append(self._get(result, request))
+        return responses
+
+    def handle_line(self, line):
+        """returns line of JSON responses for a line of JSON requests"""
+        try:
+            requests = json.loads(line)
+        except ValueError, e:
+            return json.dumps({'error': 'ValueError: %s' % e}) + "\n"
+        if isinstance(requests, list):
+            return json.dumps(self.run(requests)) + "\n"
+        return json.dumps(self.run([requests])[0]) + "\n"
+
+    def close(self):
+        """stops the workers"""
+        for pool in self.pools:
+            pool.terminate()
+        for pool in self.pools:
+            pool.join()
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line: break
+            if not line.strip(): continue
+            self.wfile.write(self.server.analysis.handle_line(line))
+            self.wfile.flush()
+
+class _TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class _UnixServer(SocketServer.ThreadingMixIn,
+                  SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+def make_server(address, workers=None, max_bytes=None, beat_table=None):
+    """returns a server listening on address, a Unix socket path or a
+    (host, port) pair, with a thread per client connection and an
+    AnalysisServer of workers (default one per cpu) as its analysis
+    attribute.  If max_bytes is given, it caps the analysis cache of each
+    worker, and if beat_table is given, workers analyse sequences with the
+    beat table in that file"""
+    # start workers before any threads
+    analysis = AnalysisServer(workers, max_bytes, beat_table)
+    try:
+        if isinstance(address, basestring):
+            if os.path.exists(address):
+                os.unlink(address)
+            server = _UnixServer(address, _RequestHandler)
+        else:
+            server = _TCPServer(tuple(address), _RequestHandler)
+    except:
+        analysis.close()
+        raise
+    server.analysis = analysis
+    return server
+
+def serve(address, workers=None, max_bytes=None, beat_table=None):
+    """serves requests on address until interrupted"""
+    server = make_server(address, workers, max_bytes, beat_table)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        server.analysis.close()
+        if isinstance(address, basestring) and os.path.exists(address):
+            os.unlink(address)
+
+class Client(object):
+    ''' Connection to an analysis server at address, a Unix socket path or
+    a (host, port) pair '''
+    def __init__(self, address):
+        if isinstance(address, basestring):
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            address = tuple(address)
+        self.socket.connect(address)
+        self.file = self.socket.makefile('rwb')
+
+    def _send(self, value):
+        self.file.write(json.dumps(value) + "\n")
+        self.file.flush()
+        line = self.file.readline()
+        if not line:
+            raise IOError, 'Server closed connection'
+        return json.loads(line)
+
+    def request(self, op, **fields):
+        """returns response to a request for op, raising ValueError if the
+        request failed"""
+        fields['op'] = op
+        response = self._send(fields)
+        if 'error' in response:
+            raise ValueError, response['error']
+        return response
+
+    def batch(self, requests):
+        """returns list of responses to list of request dictionaries, run
+        in parallel.  Failed requests have an 'error' in their response"""
+        return self._send(list(requests))
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
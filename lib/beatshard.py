@@ -0,0 +1,215 @@
+#!/bin/env python
+'''
+Sharded batches over many machines.  A manifest lists the work units
+(interval multiset, method, bois and threshold) with cost estimates,
+split into shards of about equal cost.  Each shard is claimed and run
+independently, writing a self-contained result file, and the result
+files are merged in a fixed order, so the merged results don't depend on
+how the work was split or where it ran
+'''
+
+import errno
+import hashlib
+import json
+import os
+import socket
+
+import beatsequence as BS
+import beatbatch
+import beatstore
+
+def work_units(interval_sets, methods=('getmatches',),
+               settings=(([9,5], 0.8),)):
+    """returns list of work units, one for each distinct interval multiset
+    with each method and (bois, threshold) setting, as dictionaries.
+
+    Units are in order of method, setting, then multiset key, and are
+    numbered in that order by their id"""
+    units = {}
+    for method in methods:
+        for bois, threshold in settings:
+            for i in interval_sets:
+                key = (method, tuple(bois), threshold,
+                       beatstore.multiset_key(i))
+                if key in units: continue
+                units[key] = {'intervals': sorted(i),
+                              'method': method,
+                              'bois': list(bois),
+                              'threshold': threshold,
+                              'cost': BS.permutation_count(i)}
+    units = [units[key] for key in sorted(units)]
+    for n, unit in enumerate(units):
+        unit['id'] = n
+    return units
+
+def assign_shards(units, shards):
+    """sets the shard of each unit, giving the most costly units first to
+    the shard with least cost so far"""
+    totals = [0] * shards
+    for unit in sorted(units, key=lambda u: (-u['cost'], u['id'])):
+        shard = totals.index(min(totals))
+        unit['shard'] = shard
+        totals[shard] += unit['cost']
+    return totals
+
+def write_manifest(filename, interval_sets, shards, methods=('getmatches',),
+                   settings=(([9,5], 0.8),)):
+    """writes manifest of work units for interval_sets, split into shards.
+    Returns the manifest"""
+    units = work_units(interval_sets, methods, settings)
+    manifest = {'shards': shards,
+                'shard_costs': assign_shards(units, shards),
+                'units': units}
+    f = open(filename, "wt")
+    json.dump(manifest, f, indent=1, sort_keys=True)
+    f.close()
+    return manifest
+
+def read_manifest(filename):
+    """returns manifest from filename, and a digest identifying it"""
+    f = open(filename, "rt")
+    text = f.read()
+    f.close()
+    return json.loads(text), hashlib.sha1(text).hexdigest()
+
+def shard_filename(manifest_filename, shard):
+    """returns name of result file for shard of manifest"""
+    return "%s.shard%d.jsonl" % (manifest_filename, shard)
+
+def claim_shard(manifest_filename):
+    """claims the first unclaimed shard of manifest, by creating its claim
+    file, which only one worker can do.  Returns shard number, or None if
+    all shards are claimed"""
+    manifest, digest = read_manifest(manifest_filename)
+    for shard in range(manifest['shards']):
+        claim = "%s.shard%d.claim" % (manifest_filename, shard)
+        try:
+            fd = os.open(claim, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError, e:
+            if e.errno == errno.EEXIST: continue
+            raise
+        os.write(fd, "%s %d\n" % (socket.gethostname(), os.getpid()))
+        os.close(fd)
+        return shard
+    return None
+
+def run_shard(manifest_filename, shard, workers=None, debug=False,
+              max_bytes=None, beat_table=None):
+    """runs the units of shard in a pool of workers, writing the result
+    file for the shard.  The file is written under another name and
+    renamed when complete, so a result file is always complete.
+    max_bytes and beat_table are as for beatbatch.run_batch.
+
+    Returns name of result file"""
+    manifest, digest = read_manifest(manifest_filename)
+    units = [u for u in manifest['units'] if u['shard'] == shard]
+    filename = shard_filename(manifest_filename, shard)
+    partial = filename + ".partial"
+    f = open(partial, "wt")
+    f.write(json.dumps({'manifest': digest, 'shard': shard,
+                        'units': len(units)}) + "\n")
+    args = [(u['intervals'], u['method'], u['bois'], u['threshold'])
+            for u in units]
+    try:
+        with beatbatch.running_pool(workers, max_bytes, beat_table) as pool:
+            for unit, (i, records) in zip(
+                    units, pool.imap(beatbatch._match_records_star, args)):
+                result = dict(unit)
+                result['records'] = records
+                f.write(json.dumps(result, sort_keys=True) + "\n")
+                if debug:print i,"completed"
+    finally:
+        f.close()
+    os.rename(partial, filename)
+    return filename
+
+def read_results(filename):
+    """returns header and iterator over results of a shard or merged
+    result file"""
+    f = open(filename, "rt")
+    header = json.loads(f.readline())
+    def results():
+        for line in f:
+            yield json.loads(line)
+        f.close()
+    return header, results()
+
+def merge_shards(manifest_filename, shard_filenames, filename):
+    """merges result files of shards into one result file, with results in
+    order of unit id.  Results for a unit found in more than one file must
+    agree.  Raises ValueError if a file is from another manifest, results
+    disagree, or units are missing.
+
+    Returns number of units"""
+    manifest, digest = read_manifest(manifest_filename)
+    results = {}
+    for shard_filename in shard_filenames:
+        header, shard_results = read_results(shard_filename)
+        if header['manifest'] != digest:
+            raise ValueError, "%s is not from manifest %s" % (
+                shard_filename, manifest_filename)
+        for result in shard_results:
+            n = result['id']
+            if n in results and results[n] != result:
+                raise ValueError, "Results for unit %d disagree" % n
+            results[n] = result
+    missing = len(manifest['units']) - len(results)
+    if missing:
+        raise ValueError, "%d units have no results" % missing
+    f = open(filename, "wt")
+    f.write(json.dumps({'manifest': digest, 'units': len(results)}) + "\n")
+    for n in sorted(results):
+        f.write(json.dumps(results[n], sort_keys=True) + "\n")
+    f.close()
+    return len(results)
+
+def unit_lines(result):
+    """returns lines of results for a unit, as written by getmatches or
+    findmatches for its multiset, or None where getmatches would write no
+    file"""
+    records = result['records']
+    if result['method'] == 'getmatches':
+        if not records:
+            return None
+        return ["%s:%s;%s\n" % (metric, match, boi)
+                for metric, metric_score, match, match_score, boi in records
+                if match is not None]
+    return ["%s : %s ; boi=%s\n" % (metric, match, boi)
+            for metric, metric_score, match, match_score, boi in records]
+
+def write_outputs(filename, method='getmatches', bois=[9,5], threshold=0.8):
+    """writes the output file of each multiset in merged result file, for
+    method, bois and threshold, as a single run would.  Returns list of
+    filenames written"""
+    header, results = read_results(filename)
+    written = []
+    for result in results:
+        if (result['method'] != method or result['bois'] != list(bois) or
+                result['threshold'] != threshold):
+            continue
+        lines = unit_lines(result)
+        if lines is not None:
+            output = BS.output_filename(result['intervals'])
+            BS.write_lines(output, lines)
+            written.append(output)
+    return written
+
+def joined_lines(filename, method='getmatches', bois=[9,5], threshold=0.8):
+    """returns lines of all matches for method, bois and threshold in
+    merged result file, in the format of joinfiles.py output, in the order
+    of beatstore.MatchStore.joined_lines"""
+    header, results = read_results(filename)
+    metrics = []
+    complexes = []
+    boilist = []
+    for result in results:
+        if (result['method'] != method or result['bois'] != list(bois) or
+                result['threshold'] != threshold):
+            continue
+        for metric, metric_score, match, match_score, boi in \
+                result['records']:
+            if match is None: continue
+            metrics.append(metric)
+            complexes.append(match)
+            boilist.append(boi)
+    return list(beatbatch.joined_lines(metrics, complexes, boilist))
@@ -0,0 +1,126 @@
+#!/bin/env python
+'''
+SQLite store for match results, so batch runs can be resumed, and results
+joined with a query rather than by reading text files
+'''
+
+import sqlite3
+
+import beatbatch
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS multisets (
+    id INTEGER PRIMARY KEY,
+    intervals TEXT NOT NULL,
+    method TEXT NOT NULL,
+    UNIQUE (intervals, method));
+CREATE TABLE IF NOT EXISTS metric_sequences (
+    id INTEGER PRIMARY KEY,
+    multiset_id INTEGER NOT NULL REFERENCES multisets(id),
+    position INTEGER NOT NULL,
+    intervals TEXT NOT NULL,
+    beatscore REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS metric_multiset
+    ON metric_sequences(multiset_id, position);
+CREATE TABLE IF NOT EXISTS complex_matches (
+    metric_id INTEGER PRIMARY KEY REFERENCES metric_sequences(id),
+    intervals TEXT NOT NULL,
+    beatscore REAL NOT NULL,
+    boi INTEGER NOT NULL);
+'''
+
+def multiset_key(intervals):
+    """returns the key for an interval multiset in the store"""
+    return ','.join(str(i) for i in sorted(intervals))
+
+class MatchStore(object):
+    ''' Match results for interval multisets, in an SQLite database
+
+    Results for a multiset are saved in one transaction, so a multiset is
+    either completely saved or not at all
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def is_done(self, intervals, method='getmatches'):
+        """returns true if results for intervals are saved"""
+        row = self.connection.execute(
+            'SELECT id FROM multisets WHERE intervals=? AND method=?',
+            (multiset_key(intervals), method)).fetchone()
+        return row is not None
+
+    def pending(self, interval_sets, method='getmatches'):
+        """returns the interval sets without saved results"""
+        return [i for i in interval_sets if not self.is_done(i, method)]
+
+    def save(self, intervals, method, records):
+        """saves match records for intervals, as returned by
+        beatbatch.match_records"""
+        c = self.connection
+        with c:
+            multiset_id = c.execute(
+                'INSERT INTO multisets (intervals, method) VALUES (?, ?)',
+                (multiset_key(intervals), method)).lastrowid
+            for position, (metric, metric_score, match, match_score, boi) \
+                    in enumerate(records):
+                metric_id = c.execute(
+                    'INSERT INTO metric_sequences '
+                    '(multiset_id, position, intervals, beatscore) '
+                    'VALUES (?, ?, ?, ?)',
+                    (multiset_id, position, metric, metric_score)).lastrowid
+                if match is not None:
+                    c.execute(
+                        'INSERT INTO complex_matches '
+                        '(metric_id, intervals, beatscore, boi) '
+                        'VALUES (?, ?, ?, ?)',
+                        (metric_id, match, match_score, boi))
+
+    def matches(self, method='getmatches'):
+        """iterates over (metric, complex, boi) for all saved matches, in
+        order of multiset, then metric sequence"""
+        return self.connection.execute(
+            'SELECT m.intervals, c.intervals, c.boi FROM multisets s '
+            'JOIN metric_sequences m ON m.multiset_id = s.id '
+            'JOIN complex_matches c ON c.metric_id = m.id '
+            'WHERE s.method = ? ORDER BY s.intervals, m.position',
+            (method,))
+
+    def joined_lines(self, method='getmatches'):
+        """returns lines of all saved matches, in the format of
+        joinfiles.py output.  The lines are those of joining the text
+        files, but in order of multiset, where joining the text files
+        takes them in the arbitrary order of os.listdir"""
+        matches = list(self.matches(method))
+        return list(beatbatch.joined_lines(
+            [metric for metric, match, boi in matches],
+            [match for metric, match, boi in matches],
+            [boi for metric, match, boi in matches]))
+
+def run_stored_batch(filename, interval_sets, method='getmatches',
+                     workers=None, debug=False, max_bytes=None,
+                     beat_table=None):
+    """runs method ('getmatches' or 'findmatches') on each interval set
+    in a pool of workers, saving results to the MatchStore in filename
+    as each set finishes.  Sets with results already saved are skipped,
+    so an interrupted batch carries on where it stopped.  max_bytes and
+    beat_table are as for beatbatch.run_batch.
+
+    Returns number of interval sets run"""
+    store = MatchStore(filename)
+    try:
+        todo = beatbatch.by_cost(store.pending(interval_sets, method))
+        if debug:print len(interval_sets)-len(todo),"already done"
+        with beatbatch.running_pool(workers, max_bytes, beat_table) as pool:
+            for i, records in pool.imap_unordered(
+                    beatbatch._match_records_star,
+                    [(i, method) for i in todo]):
+                store.save(i, method, records)
+                if debug:print i,"completed"
+    finally:
+        store.close()
+    return len(todo)
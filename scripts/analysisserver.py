@@ -0,0 +1,37 @@
+#!/bin/env python
+'''Runs an analysis server, keeping analyses warm between requests
+
+usage: analysisserver.py (--socket PATH | --port PORT) [--workers W]
+                         [--max-bytes N] [--beat-table FILE]
+
+Requests are lines of JSON, as described in beatserver
+'''
+
+import argparse
+
+import beatserver
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    where = parser.add_mutually_exclusive_group(required=True)
+    where.add_argument('--socket', help='Unix socket path')
+    where.add_argument('--port', type=int, help='localhost TCP port')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--max-bytes', type=int,
+                        help='cap on analysis cache of each worker')
+    parser.add_argument('--beat-table',
+                        help='beat table file from createbeattable.py')
+    args = parser.parse_args()
+    address = args.socket
+    if address is None:
+        address = ('127.0.0.1', args.port)
+    print "serving on",address
+    try:
+        beatserver.serve(address, args.workers, args.max_bytes,
+                         args.beat_table)
+    except KeyboardInterrupt:
+        print "stopped"
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+#!/bin/env python
+'''Times the slow parts of beatsequence, recording wall time, peak memory
+and the number of objects held by the results for each benchmark.
+
+Interval sets are all those of 5-9 intervals of at most 4, adding up to 12,
+as in creatematches.py.  Each benchmark runs in its own process, with an
+empty analysis cache.
+
+usage:
+  benchmark.py --save baseline.json     # record a baseline
+  benchmark.py --compare baseline.json  # compare against a baseline
+'''
+
+import os
+import sys
+import gc
+import Queue
+import json
+import time
+import shutil
+import tempfile
+import resource
+import argparse
+import traceback
+import multiprocessing
+
+import beatsequence as BS
+
+LENGTHS = range(5, 10)
+COLLECTION_SIZES = [5, 10, 20, 50]
+
+# measures compared with a baseline, with the change in each which is
+# too small to count as a regression, however large as a fraction
+MEASURES = [('time', 0.001), ('peak_kb', 1024), ('objects', 100)]
+
+
+def interval_sets(length, total=12, largest=4):
+    """returns sorted interval sets of given length adding up to total"""
+    return list(BS.partitions(total, largest, length, length))
+
+
+def bench_all_permutations(length):
+    return [BS.Sequence(i).all_permutations() for i in interval_sets(length)]
+
+
+def bench_all_metric(length):
+    return [BS.Sequence(i).all_metric() for i in interval_sets(length)]
+
+
+def bench_matched_complex(length):
+    return [s.matched_complex() for i in interval_sets(length)
+            for s in BS.Sequence(i).all_metric()]
+
+
+def bench_getmatches(length):
+    return [BS.getmatches(i) for i in interval_sets(length)]
+
+
+def bench_findmatches(length):
+    return [BS.findmatches(i) for i in interval_sets(length)]
+
+
+def setup_append_attempt(size):
+    """returns size matched metric sequences, from the longer interval sets
+    first"""
+    targets = []
+    for length in reversed(LENGTHS):
+        for i in interval_sets(length):
+            for s in BS.Sequence(i).all_metric():
+                ms = BS.MatchedSequence(s)
+                if ms.matches:
+                    targets.append(ms)
+    return targets[:size]
+
+
+def bench_append_attempt(targets):
+    msc = BS.MatchedSequenceCollection()
+    for ms in targets:
+        ms.to_first_match()
+        try:
+            msc.append_attempt(ms)
+        except ValueError:
+            continue
+    return msc
+
+
+# name, benchmark function, argument, setup function for argument
+BENCHMARKS = ([('all_permutations/%d' % n, bench_all_permutations, n, None)
+               for n in LENGTHS] +
+              [('all_metric/%d' % n, bench_all_metric, n, None)
+               for n in LENGTHS] +
+              [('matched_complex/%d' % n, bench_matched_complex, n, None)
+               for n in LENGTHS] +
+              [('getmatches/%d' % n, bench_getmatches, n, None)
+               for n in LENGTHS] +
+              [('findmatches/%d' % n, bench_findmatches, n, None)
+               for n in LENGTHS] +
+              [('append_attempt/%d' % n, bench_append_attempt, n,
+                setup_append_attempt)
+               for n in COLLECTION_SIZES])
+
+
+def _run_child(func, arg, setup, repeat, queue):
+    """runs one benchmark in a fresh process, putting results, or the
+    traceback of an error, in queue"""
+    workdir = tempfile.mkdtemp()
+    try:
+        os.chdir(workdir)
+        os.mkdir('outputsequences')
+        if setup is not None:
+            arg = setup(arg)
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        times = []
+        for r in range(repeat):
+            BS.analysis_cache.clear()
+            gc.collect()
+            objects_before = len(gc.get_objects())
+            start = time.time()
+            result = func(arg)
+            times.append(time.time() - start)
+            # objects held by the result and caches
+            gc.collect()
+            objects = len(gc.get_objects()) - objects_before
+            del result
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        queue.put({'time': min(times),
+                   'peak_kb': rss_after - rss_before,
+                   'objects': objects})
+    except Exception:
+        queue.put({'error': traceback.format_exc()})
+    finally:
+        shutil.rmtree(workdir)
+
+
+def run_benchmark(func, arg, setup=None, repeat=3):
+    """returns dictionary of time, peak memory and object count for
+    benchmark function func called with arg, or with the result of
+    setup(arg) if setup is given.  If the benchmark fails, the dictionary
+    has only an error, with its traceback"""
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=_run_child,
+                                args=(func, arg, setup, repeat, queue))
+    p.start()
+    while True:
+        try:
+            result = queue.get(timeout=1)
+            break
+        except Queue.Empty:
+            # the child can die without putting anything in the queue
+            if not p.is_alive() and queue.empty():
+                result = {'error': 'benchmark process exited with code %s'
+                          % p.exitcode}
+                break
+    p.join()
+    return result
+
+
+def run_all(names=None, repeat=3):
+    """returns dictionary of results for each benchmark"""
+    results = {}
+    for name, func, arg, setup in BENCHMARKS:
+        if names and not [n for n in names if name.startswith(n)]:
+            continue
+        results[name] = run_benchmark(func, arg, setup, repeat)
+        if 'error' in results[name]:
+            print "%-22s FAILED" % name
+            print results[name]['error']
+        else:
+            print "%-22s %10.4fs %8dkB %8d objects" % (
+                name, results[name]['time'], results[name]['peak_kb'],
+                results[name]['objects'])
+        sys.stdout.flush()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """prints comparison of results with baseline, returning names of
+    benchmarks which failed, or which took more than tolerance (as a
+    fraction) more time, peak memory or objects than baseline"""
+    worse = []
+    print
+    print "%-22s %-8s %10s %10s %8s" % ('benchmark', 'measure', 'baseline',
+                                        'now', 'ratio')
+    for name in sorted(results):
+        if 'error' in results[name]:
+            print "%-22s FAILED" % name
+            worse.append(name)
+            continue
+        if name not in baseline or 'error' in baseline[name]:
+            continue
+        for measure, slack in MEASURES:
+            old = baseline[name][measure]
+            new = results[name][measure]
+            ratio = new * 1.0 / old if old > 0 else float('inf')
+            flag = ''
+            if ratio > 1 + tolerance and new - old > slack:
+                flag = ' WORSE'
+                if name not in worse: worse.append(name)
+            print "%-22s %-8s %10.4g %10.4g %7.2fx%s" % (
+                name, measure, old, new, ratio, flag)
+    return worse
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--save', metavar='FILE',
+                        help='write results to baseline FILE')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare results with baseline FILE')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='fraction more time, peak memory or objects '
+                        'than baseline counted as a regression '
+                        '(default 0.25)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of each benchmark, best is kept')
+    parser.add_argument('names', nargs='*',
+                        help='only run benchmarks starting with these names')
+    args = parser.parse_args()
+    results = run_all(args.names, args.repeat)
+    if args.save:
+        f = open(args.save, 'wt')
+        json.dump(results, f, indent=1, sort_keys=True)
+        f.close()
+    if args.compare:
+        f = open(args.compare, 'rt')
+        baseline = json.load(f)
+        f.close()
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+    if [name for name in results if 'error' in results[name]]:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
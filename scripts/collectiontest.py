@@ -56,3 +56,37 @@ except ValueError:
 print "check collection has correctly reverted"
 for i in testcollection.collection:
     print i.preferred_match.intervals
+
+#check against trying every assignment, starting from collections whose
+#preferred matches were set by hand, clashing or not as low as possible
+print "check against every assignment"
+import itertools
+import random
+def best_total(options):
+    best=None
+    for choice in itertools.product(*[range(len(o)) for o in options]):
+        keys=[options[t][n] for t,n in enumerate(choice)]
+        if len(set(keys))==len(keys):
+            if best is None or sum(choice)<best:best=sum(choice)
+    return best
+keys=[BS.Sequence(s) for s in ["123","132","213","231","312","321"]]
+target=BS.Sequence("111")
+rng=random.Random(0)
+wrong=0
+for trial in range(200):
+    options=[rng.sample(keys,rng.randint(1,4)) for n in range(rng.randint(2,4))]
+    mseqs=[BS.MatchedSequence(target,pairs=[(k,5) for k in o])
+           for o in options]
+    for m,o in zip(mseqs[:-1],options):
+        m.preferred_match_no=rng.randrange(len(o))
+    collection=BS.MatchedSequenceCollection(mseqs[:-1])
+    try:
+        collection.append_attempt(mseqs[-1])
+    except ValueError:
+        if best_total(options) is not None:wrong+=1
+        continue
+    matches=[str(m.preferred_match) for m in collection.collection]
+    total=sum(m.preferred_match_no for m in collection.collection)
+    if len(set(matches))!=len(matches) or total!=best_total(options):
+        wrong+=1
+print wrong,"wrong (should be 0)"
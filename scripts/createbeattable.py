@@ -0,0 +1,18 @@
+#!/bin/env python
+'''Writes a beat table file, holding the beat analysis for every onset
+pattern of a given length
+
+usage: createbeattable.py [length] [filename]
+'''
+
+import sys
+
+import beatsequence as BS
+
+length=12
+if len(sys.argv)>1:length=int(sys.argv[1])
+filename="beattable%d.bin" % length
+if len(sys.argv)>2:filename=sys.argv[2]
+print "writing beat table for length",length,"to",filename
+BS.write_beat_table(filename, length)
+print "done"
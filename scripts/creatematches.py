@@ -1,27 +1,58 @@
 #!/bin/env python
-'''Creates as many matches as possible for metric sequences, with 5-7 intervals'''
+'''Creates as many matches as possible for metric sequences, with 5-7 intervals
+
+usage: creatematches.py [workers] [database]
+       creatematches.py database
+       creatematches.py [--workers W] [--database FILE]
+
+Interval sets are matched in parallel, by default with one worker per cpu.
+If a database is given, results are saved there instead of to text files,
+and a batch that was interrupted carries on where it stopped.  If the
+database name ends in .bres, results are appended to that binary result
+file instead (see beatresults)
+'''
+
+import argparse
 
 import beatsequence as BS
+import beatbatch
+import beatstore
+import beatresults
+
+parser = argparse.ArgumentParser(description=__doc__,
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('arguments', nargs='*', metavar='workers|database',
+                    help='worker count, database, or both')
+parser.add_argument('--workers', type=int)
+parser.add_argument('--database')
+args = parser.parse_args()
+workers = args.workers
+database = args.database
+if len(args.arguments)>2:parser.error("too many arguments")
+for n, argument in enumerate(args.arguments):
+    try:
+        value=int(argument)
+    except ValueError:
+        value=None
+    # a number is the worker count, unless it follows one
+    if value is not None and n==0:
+        if workers is None:workers=value
+    elif database is None:
+        database=argument
 
-#First, create a list of all combinations of intervals, taking those which add up to 12
+#First, create a list of all combinations of 5-9 intervals up to 4, adding up to 12
 print "calculating possible combinations"
 S=[]
-for length in range(5,10):
-    L=[4 for n in range(length)]
-    for i in BS.valueperm(L):
-        #work out total, gp to next if not 12
-        total=0
-        for n in i:
-            total+=n
-        if total!=12:continue
-        i.sort()
-        if i not in S:
-            print "added",i
-            S.append(i)
+for i in BS.partitions(12,4,5,9):
+    print "added",i
+    S.append(i)
 
 #now run the match creator on S:
-for i in S:
-    BS.getmatches(i,debug=True)
-    print i,"completed"
+if database is not None and database.endswith(".bres"):
+    beatresults.run_result_batch(database,S,workers=workers,debug=True)
+elif database is not None:
+    beatstore.run_stored_batch(database,S,workers=workers,debug=True)
+else:
+    beatbatch.run_batch(S,workers=workers,debug=True)
 
 i=raw_input("Finished. Press enter to close")
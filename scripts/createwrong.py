@@ -1,54 +1,72 @@
 #!/bin/env python
-"""Goes through output file from joinfiles, and creates wrong versions of each sequence"""
+"""Goes through output file from joinfiles, and creates wrong versions of each sequence
+
+usage: createwrong.py [seed] [results.bres]
+
+Wrong versions are chosen at random, repeatably for a given seed.
+Sequences without a possible wrong version get "None found".  If a
+result file is given (as joined by joinfiles.py), matches are read from
+it rather than from outputsequences/output.txt
+"""
+
+import sys
 
 import beatsequence as BS
+import beatresults
 
-inputfile=open("outputsequences/output.txt","rt")
+seed=None
+if len(sys.argv)>1:seed=int(sys.argv[1])
+if len(sys.argv)>2:
+    results=beatresults.ResultFile(sys.argv[2])
+    # read through the file once for each part, not held in memory
+    metrics=(BS.Sequence(m.tolist()) for m,c,b in results.matches())
+    complexes=(BS.Sequence(c.tolist()) for m,c,b in results.matches())
+else:
+    metrics=None
+    inputfile=open("outputsequences/output.txt","rt")
+    #go past first two irrelevant lines
+    inputfile.readline()
+    inputfile.readline()
 outputfile=open("outputsequences/wrongversions.txt","wt")
-#go past first two irrelevant lines
-inputfile.readline()
-inputfile.readline()
-allwrongs=[]
-num=0
-while 1==1:
+sequences=[]
+while metrics is None:
     s=inputfile.readline()
     if s=="\n":break
     s=s[:s.find("\n")]
-    seq=BS.Sequence(s)
-    while 1==1:
-        wrongversion=seq.wrong_version()
-        if wrongversion not in allwrongs:
-            allwrongs.append(wrongversion)
-            num+=1
-            print "wrong version added",num
-            break
+    sequences.append(BS.Sequence(s))
+if metrics is not None:sequences=metrics
+allwrongs=BS.unique_wrong_versions(sequences,seed,missing=True)
+print len([w for w in allwrongs if w is not None]),"metric wrong versions added"
 print "outputting"
 #write these to output file
 outputfile.write("Metric wrong versions\n\n")
 for i in allwrongs:
-    outputfile.write(i.__str__()+"\n")
-#go through two more irrelevant lines
-inputfile.readline()
-inputfile.readline()
-allwrongs=[]
+    if i is None:
+        outputfile.write("None found\n")
+    else:
+        outputfile.write(i.__str__()+"\n")
 print "moved on to complex"
-while 1==1:
+sequences=[]
+if metrics is None:
+    #go through two more irrelevant lines
+    inputfile.readline()
+    inputfile.readline()
+while metrics is None:
     s=inputfile.readline()
     if s=="\n":break
     s=s[:s.find("\n")]
-    seq=BS.Sequence(s)
-    while 1==1:
-        wrongversion=seq.wrong_version()
-        if wrongversion not in allwrongs:
-            allwrongs.append(wrongversion)
-            num+=1
-            print "wrong version added",seq
-            break
+    sequences.append(BS.Sequence(s))
+if metrics is not None:sequences=complexes
+allwrongs=BS.unique_wrong_versions(sequences,seed,missing=True)
+print len([w for w in allwrongs if w is not None]),"complex wrong versions added"
 #write these to output file
 print "outputting"
 outputfile.write("\nComplex wrong versions\n\n")
 for i in allwrongs:
-    outputfile.write(i.__str__()+"\n")
+    if i is None:
+        outputfile.write("None found\n")
+    else:
+        outputfile.write(i.__str__()+"\n")
 print "output done"
 outputfile.close()
 
@@ -1,4 +1,39 @@
+'''Joins match results into outputsequences/output.txt
+
+usage: joinfiles.py [database]
+       joinfiles.py results.bres [results.bres ...]
+
+With a database (as written by beatstore.run_stored_batch), results are
+read from the database.  With result files (as written by
+beatresults.run_result_batch), they are joined, in the order given, into
+outputsequences/results.bres, and output.txt is written from that.
+Otherwise results are read from the text files in outputsequences, in
+the order the directory lists them, so only joins of a database or of
+result files are in a fixed order
+'''
+
 import os
+import sys
+
+import beatbatch
+import beatstore
+import beatresults
+
+if len(sys.argv)>1 and sys.argv[1].endswith(".bres"):
+    beatresults.join_results(sys.argv[1:],"outputsequences/results.bres")
+    outputfile=open("outputsequences/output.txt", "wt")
+    outputfile.writelines(
+        beatresults.joined_lines("outputsequences/results.bres"))
+    outputfile.close()
+    sys.exit()
+
+if len(sys.argv)>1:
+    store=beatstore.MatchStore(sys.argv[1])
+    outputfile=open("outputsequences/output.txt", "wt")
+    outputfile.writelines(store.joined_lines())
+    outputfile.close()
+    store.close()
+    sys.exit()
 
 os.chdir("outputsequences")
 
@@ -18,14 +53,7 @@ for inputfilename in os.listdir(os.getcwd()):
         metricsequences.append(s[:s.find(":")])
         complexsequences.append(s[s.find(":")+1:s.find(";")])
         bois.append(s[s.find(";")+1:s.find("\n")])
-outputfile.write("Metric Simples\n\n")
-for i in metricsequences:
-    outputfile.write(i+"\n")
-outputfile.write("\nComplexsequences\n\n")
-for i in complexsequences:
-    outputfile.write(i+"\n")
-outputfile.write("\nBeats of Interest\n")
-for i in bois:
-    outputfile.write(i+"\n")
+outputfile.writelines(
+    beatbatch.joined_lines(metricsequences,complexsequences,bois))
 
 outputfile.close()
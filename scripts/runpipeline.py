@@ -0,0 +1,21 @@
+#!/bin/env python
+'''Creates matches, and their wrong versions, for all sets of 5-9 intervals
+adding up to 12, writing each stimulus to a file as soon as it is ready
+
+usage: runpipeline.py [workers] [seed]
+
+Stimuli go to outputsequences/stimuli.txt, one per line, as
+metric:complex;boi;wrong metric:wrong complex
+'''
+
+import sys
+
+import beatpipeline
+
+workers=None
+if len(sys.argv)>1:workers=int(sys.argv[1])
+seed=None
+if len(sys.argv)>2:seed=int(sys.argv[2])
+n=beatpipeline.run_pipeline("outputsequences/stimuli.txt",workers=workers,
+                            seed=seed,debug=True)
+print n,"stimuli written"
@@ -0,0 +1,32 @@
+#!/bin/env python
+'''Creates matches for a long interval set from random orderings of it
+
+usage: samplematches.py intervals seconds [seed]
+
+Intervals are given as digits, e.g. 1112223334441.  Orderings are drawn
+for the given number of seconds, and matches found from those are written
+to outputsequences as by getmatches
+'''
+
+import sys
+
+import beatsequence as BS
+import beatsample
+
+if len(sys.argv)<3:
+    print __doc__
+    sys.exit(1)
+i=[int(e) for e in sys.argv[1]]
+seconds=float(sys.argv[2])
+seed=None
+if len(sys.argv)>3:seed=int(sys.argv[3])
+sampler=beatsample.OrderingSampler(i,seed=seed)
+coverage=sampler.run(seconds=seconds)
+for key in sorted(coverage):
+    print key,":",coverage[key]
+results=beatsample.getmatches_results(sampler)
+if results is None:
+    print "No metric sequences found"
+else:
+    BS.write_lines(BS.output_filename(i),BS.results_lines(results))
+    print len([r for r in results if r[1] is not None]),"matches written"
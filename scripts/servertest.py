@@ -0,0 +1,37 @@
+#!/bin/env python
+'''Checks that failed requests to an analysis server get error responses,
+leaving other responses in a batch and the connection intact
+'''
+
+import os
+import tempfile
+import threading
+
+import beatserver
+
+address = os.path.join(tempfile.mkdtemp(), 'beatserver.sock')
+server = beatserver.make_server(address, workers=2)
+thread = threading.Thread(target=server.serve_forever)
+thread.daemon = True
+thread.start()
+try:
+    client = beatserver.Client(address)
+    responses = client.batch([
+        {'op': 'sequence', 'sequence': '22314', 'id': 1},
+        # basegroup 0 raises ZeroDivisionError in the worker
+        {'op': 'all_metric', 'sequence': '12234', 'basegroup': 0, 'id': 2},
+        {'op': 'bogus', 'id': 3},
+        {'op': 'getmatches', 'intervals': [2,2,3,1,4], 'id': 4}])
+    assert [r['id'] for r in responses] == [1, 2, 3, 4]
+    assert 'error' not in responses[0] and 'error' not in responses[3]
+    assert 'error' in responses[1] and 'error' in responses[2]
+    assert responses[3]['records']
+    assert client.request('ping', id=5) == {'id': 5}
+    client.close()
+    print "server test passed"
+finally:
+    server.shutdown()
+    server.server_close()
+    server.analysis.close()
+    os.unlink(address)
+    os.rmdir(os.path.dirname(address))
@@ -0,0 +1,83 @@
+#!/bin/env python
+'''Runs matches for many interval sets as shards, on one or more machines
+
+usage:
+  shardmatches.py manifest MANIFEST SHARDS [options]
+      writes manifest of work units split into SHARDS shards
+  shardmatches.py run MANIFEST [--shard N] [--workers W]
+      runs shard N, or claims and runs unclaimed shards until none are left
+  shardmatches.py merge MANIFEST MERGED
+      merges the shard results of MANIFEST into MERGED, and writes
+      outputsequences/output.txt and, with --outputs, the output file of
+      each interval set
+'''
+
+import argparse
+import glob
+
+import beatsequence as BS
+import beatshard
+
+def parse_setting(text):
+    """returns (bois, threshold) from text like 9,5:0.8"""
+    bois, threshold = text.split(':')
+    return [int(b) for b in bois.split(',')], float(threshold)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('manifest')
+    p.add_argument('manifest')
+    p.add_argument('shards', type=int)
+    p.add_argument('--totals', type=int, nargs='+', default=[12],
+                   help='bar lengths to use (default 12)')
+    p.add_argument('--largest', type=int, default=4)
+    p.add_argument('--min-length', type=int, default=5)
+    p.add_argument('--max-length', type=int, default=9)
+    p.add_argument('--method', action='append',
+                   choices=['getmatches', 'findmatches'])
+    p.add_argument('--setting', action='append', type=parse_setting,
+                   help='bois and threshold, like 9,5:0.8')
+    p = sub.add_parser('run')
+    p.add_argument('manifest')
+    p.add_argument('--shard', type=int)
+    p.add_argument('--workers', type=int)
+    p = sub.add_parser('merge')
+    p.add_argument('manifest')
+    p.add_argument('merged')
+    p.add_argument('--outputs', action='store_true')
+    args = parser.parse_args()
+
+    if args.command == 'manifest':
+        S = []
+        for total in args.totals:
+            S += BS.partitions(total, args.largest, args.min_length,
+                               args.max_length)
+        manifest = beatshard.write_manifest(
+            args.manifest, S, args.shards,
+            args.method or ['getmatches'],
+            args.setting or [([9,5], 0.8)])
+        print len(manifest['units']),"units, shard costs",\
+            manifest['shard_costs']
+    elif args.command == 'run':
+        if args.shard is not None:
+            beatshard.run_shard(args.manifest, args.shard, args.workers)
+            return
+        while True:
+            shard = beatshard.claim_shard(args.manifest)
+            if shard is None: break
+            print "running shard",shard
+            beatshard.run_shard(args.manifest, shard, args.workers)
+    elif args.command == 'merge':
+        shards = sorted(glob.glob(args.manifest + '.shard*.jsonl'))
+        print beatshard.merge_shards(args.manifest, shards, args.merged),\
+            "units merged"
+        f = open("outputsequences/output.txt", "wt")
+        f.writelines(beatshard.joined_lines(args.merged))
+        f.close()
+        if args.outputs:
+            beatshard.write_outputs(args.merged)
+
+if __name__ == '__main__':
+    main()